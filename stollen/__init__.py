@@ -1,5 +1,7 @@
 import os
 import time
+import hashlib
+import ctypes
 import numpy as np
 import gurobipy as gp
 import matplotlib.pyplot as plt
@@ -7,9 +9,11 @@ import matplotlib.pyplot as plt
 from enum import Enum
 from tqdm import tqdm
 from functools import partial
-from multiprocessing import Pool
-from collections import defaultdict
-from scipy.optimize import linprog, minimize
+from multiprocessing import Pool, RawArray
+from collections import defaultdict, OrderedDict
+from scipy.optimize import linprog, minimize, nnls
+from scipy.spatial import ConvexHull
+from scipy.sparse import csc_matrix
 from gurobipy import GRB
 
 
@@ -18,11 +22,234 @@ from gurobipy import GRB
 # https://stackoverflow.com/questions/14124588/shared-memory-in-multiprocessing
 W = None
 b = None
+# Flags classes for which we already have a witness (shared by processes)
+CERTIFIED = None
 
 # Default bounds used if not overrided.
 LB = -100
 UB = 100
 
+# QHULL is extremely slow if run with more than 9 DIM.
+QHULL_MAX_DIM = 9
+# Threads used by each Gurobi LP in the exact stage
+LP_THREADS = 1
+# Number of competitors the active set LP starts from
+ACTIVE_SET_SIZE = 32
+# Largest support the first order method polishes its dual weights on,
+# NNLS grows about cubically with it and the LP is faster beyond this
+POLISH_MAX_SUPPORT = 1024
+# Witnesses of the approximate stage that beat the runner up by less than
+# this fraction of the largest activation are checked exactly
+APPROX_RTOL = 1e-6
+
+# Per process cache of quantities derived from W (e.g. Gram columns).
+# Entries are keyed on the identity of W, so they are rebuilt if W changes.
+W_CACHE = dict()
+
+
+# Structure of the last few W we checked (rank, conditioning, row space),
+# keyed on a hash of their contents so that it survives copies of the same W.
+PRECHECKS = OrderedDict()
+PRECHECKS_SIZE = 4
+# Number of rows of W cast to float64 at a time by the precheck
+PRECHECK_BLOCK_SIZE = 4096
+
+
+def cached_for(W, key, factory):
+    """Return the cached object for key, calling factory() to build it
+    if we have not built one for this W yet."""
+    entry = W_CACHE.get(key)
+    if entry is None or entry[0] is not W:
+        entry = (W, factory())
+        W_CACHE[key] = entry
+    return entry[1]
+
+
+class QuantizedWeights(object):
+    """Softmax weights stored as int8 codes, or int4 codes packed two per
+    byte, with one scale per row: W[i] = scales[i] * codes[i].
+    Implements the parts of the ndarray interface that braid reflect needs
+    (shape, dtype, indexing rows and dot), dequantizing blocks of rows to
+    dtype as needed, so that the dense W is never kept in memory.
+    The verdicts are for the dequantized weights the model computes with."""
+    def __init__(self, codes, scales, bits=8, dim=None, dtype=np.float32,
+                 block_size=PRECHECK_BLOCK_SIZE):
+        super(QuantizedWeights, self).__init__()
+        if bits not in (4, 8):
+            raise ValueError('Only int8 and int4 weights are supported, got %d bits' % bits)
+        codes = np.asarray(codes)
+        if bits == 8 and codes.dtype != np.int8:
+            raise ValueError('int8 weights must be stored as int8, got %s' % codes.dtype)
+        if bits == 4:
+            if codes.dtype.itemsize != 1:
+                raise ValueError('Packed int4 weights must be stored in bytes, got %s'
+                                 % codes.dtype)
+            # Bytes packed by torch are often int8, >> would sign extend them
+            codes = codes.view(np.uint8)
+        self.codes = codes
+        self.scales = np.asarray(scales, dtype=np.float32).ravel()
+        self.bits = bits
+        if dim is None:
+            dim = self.codes.shape[1] * (8 // bits)
+        self.shape = (self.codes.shape[0], dim)
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        assert len(self.scales) == self.shape[0]
+
+    @classmethod
+    def quantize(cls, W, bits=8, dtype=np.float32):
+        """Symmetric per row quantization of a dense W."""
+        W = np.asarray(W, dtype=np.float32)
+        qmax = 2 ** (bits - 1) - 1
+        scales = np.abs(W).max(axis=1) / qmax
+        scales[scales == 0] = 1.
+        codes = np.clip(np.rint(W / scales.reshape(-1, 1)), -qmax - 1, qmax).astype(np.int8)
+        if bits == 4:
+            if W.shape[1] % 2:
+                codes = np.hstack([codes, np.zeros((len(codes), 1), dtype=np.int8)])
+            # Low nibble holds the even columns, high nibble the odd ones
+            nibbles = codes.view(np.uint8) & 0x0F
+            codes = nibbles[:, 0::2] | (nibbles[:, 1::2] << 4)
+        return cls(codes, scales, bits=bits, dim=W.shape[1], dtype=dtype)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def astype(self, dtype, copy=True):
+        """Same codes, dequantized to dtype. The codes are never copied."""
+        return QuantizedWeights(self.codes, self.scales, bits=self.bits, dim=self.shape[1],
+                                dtype=dtype, block_size=self.block_size)
+
+    def unpack(self, codes):
+        """Signed integer codes of shape (..., dim) from stored codes."""
+        if self.bits == 8:
+            return codes
+        unpacked = np.empty(codes.shape[:-1] + (2 * codes.shape[-1],), dtype=np.int8)
+        unpacked[..., 0::2] = codes & 0x0F
+        unpacked[..., 1::2] = codes >> 4
+        # Sign extend the 4 bit values
+        unpacked = (unpacked ^ 8) - 8
+        return unpacked[..., :self.shape[1]]
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        codes = self.unpack(self.codes[rows])
+        scales = self.scales[rows]
+        dense = codes * np.asarray(scales, dtype=self.dtype)[..., np.newaxis]
+        return dense.astype(self.dtype, copy=False)[..., cols]
+
+    def dequantize(self):
+        """Dense (C, dim) W in dtype."""
+        W = np.empty(self.shape, dtype=self.dtype)
+        for start in range(0, self.shape[0], self.block_size):
+            W[start:start + self.block_size] = self[start:start + self.block_size]
+        return W
+
+    def dot(self, x):
+        """W.dot(x) for x of shape (dim,) or (dim, k), one block of rows
+        dequantized at a time."""
+        x = np.asarray(x)
+        out = np.empty((self.shape[0],) + x.shape[1:], dtype=np.result_type(self.dtype, x.dtype))
+        for start in range(0, self.shape[0], self.block_size):
+            block = self[start:start + self.block_size]
+            out[start:start + self.block_size] = block.astype(out.dtype, copy=False).dot(x)
+        return out
+
+
+def dense_weights(W):
+    """W as an ndarray, dequantizing QuantizedWeights."""
+    if isinstance(W, QuantizedWeights):
+        return W.dequantize()
+    return W
+
+
+def content_hash(W):
+    """SHA-1 of the contents of W, of its codes and scales if quantized."""
+    digest = hashlib.sha1()
+    parts = (W.codes, W.scales) if isinstance(W, QuantizedWeights) else (W,)
+    for part in parts:
+        digest.update(np.ascontiguousarray(part).data)
+    return digest.hexdigest()
+
+
+def precheck(W, block_size=PRECHECK_BLOCK_SIZE):
+    """Rank, condition number, singular values and a basis (rank, dim) of
+    the row space of W (None if W has full column rank). We only need the
+    (dim, dim) Gram matrix, which we accumulate over blocks of rows in
+    float64 instead of copying or decomposing all of W."""
+    key = (W.shape, np.dtype(W.dtype).str, content_hash(W))
+    info = PRECHECKS.get(key)
+    if info is not None:
+        PRECHECKS.move_to_end(key)
+        return info
+    num_classes, dim = W.shape
+    G = np.zeros((dim, dim))
+    for start in range(0, num_classes, block_size):
+        block = W[start:start + block_size].astype(np.float64)
+        G += block.T.dot(block)
+    evals, evecs = np.linalg.eigh(G)
+    # Eigenvalues of the Gram matrix are the squared singular values
+    evals, evecs = evals[::-1], evecs[:, ::-1]
+    S = np.sqrt(np.clip(evals, 0., None))
+    # Eigenvalues of G are only accurate to about N * eps * max(evals), so
+    # we count singular values above S_max * sqrt(N * eps). This is looser
+    # than the S_max * N * eps of np.linalg.matrix_rank, smaller singular
+    # values cannot be told apart from zero through the Gram matrix.
+    tol = evals.max(initial=0.) * max(W.shape) * np.finfo(np.float64).eps
+    rank = int((evals > tol).sum())
+    info = dict(rank=rank,
+                condition=S[0] / S[-1] if rank == dim else np.inf,
+                singular_values=S,
+                basis=evecs[:, :rank].T.copy() if rank < dim else None)
+    PRECHECKS[key] = info
+    while len(PRECHECKS) > PRECHECKS_SIZE:
+        PRECHECKS.popitem(last=False)
+    return info
+
+
+def duplicate_rows(W, block_size=PRECHECK_BLOCK_SIZE):
+    """Groups of classes with identical weights, found by hashing the
+    rows of W. Returns a list of arrays of class indices, one for each
+    group with more than one class."""
+    num_classes, dim = W.shape
+    groups = defaultdict(list)
+    for start in range(0, num_classes, block_size):
+        # Adding zero maps -0. to 0., which compare equal but hash differently
+        block = np.ascontiguousarray(W[start:start + block_size] + 0.)
+        for offset, row in enumerate(block):
+            groups[hashlib.sha1(row.data).digest()].append(start + offset)
+    return [np.array(group, dtype=np.int64) for group in groups.values() if len(group) > 1]
+
+
+def near_duplicate_rows(W, b=None, tol=1e-6, block_size=1024, seed=0):
+    """Pairs of classes whose rows of [W, b] are within distance tol.
+    Rows that are close have close projections on any unit vector, so we
+    sort the rows by a random projection and only compare each block of
+    rows to the rows whose projection is less than tol away.
+    Returns a dict from each class to the list of its near duplicates."""
+    F = W.astype(np.float64)
+    if b is not None:
+        F = np.hstack([F, b.reshape(-1, 1).astype(np.float64)])
+    num_classes = F.shape[0]
+    u = np.random.RandomState(seed).normal(size=F.shape[1])
+    proj = F.dot(u / np.linalg.norm(u))
+    order = np.argsort(proj)
+    proj = proj[order]
+    sq_norms = np.einsum('ij,ij->i', F, F)
+    near = defaultdict(list)
+    for start in range(0, num_classes, block_size):
+        end = min(start + block_size, num_classes)
+        stop = np.searchsorted(proj, proj[end - 1] + tol, side='right')
+        rows, cands = order[start:end], order[start:stop]
+        sq_dists = sq_norms[rows].reshape(-1, 1) + sq_norms[cands] - 2 * F[rows].dot(F[cands].T)
+        # Only compare each pair once, from the row with the smaller projection
+        later = np.arange(start, stop) > np.arange(start, end).reshape(-1, 1)
+        for i, j in zip(*np.nonzero(later & (sq_dists <= tol ** 2))):
+            near[int(rows[i])].append(int(cands[j]))
+            near[int(cands[j])].append(int(rows[i]))
+    return {k: sorted(v) for k, v in near.items()}
+
 
 def is_in_bounds(p, lb, ub):
     in_bounds = True
@@ -33,9 +260,68 @@ def is_in_bounds(p, lb, ub):
     return in_bounds
 
 
+def in_bounds(points, lb, ub):
+    """Vectorised is_in_bounds for the columns of a (DIM, K) matrix."""
+    return ((points >= lb) & (points <= ub)).all(axis=0)
+
+
+def is_witness(class_idx, point, W, b=None, lb=LB, ub=UB):
+    """Whether class_idx is the unique argmax at point within bounds."""
+    point = np.asarray(point).ravel()
+    if not in_bounds(point.reshape(-1, 1), lb, ub)[0]:
+        return False
+    act = W.dot(point)
+    if b is not None:
+        act = act + b.ravel()
+    return act[class_idx] == act.max() and (act == act[class_idx]).sum() == 1
+
+
+def verify_witnesses(class_idxs, points, W, b=None, lb=LB, ub=UB, block_size=1024, rtol=0.,
+                     row_block_size=PRECHECK_BLOCK_SIZE):
+    """Vectorised is_witness for a sequence of K points, evaluated in
+    float64. We gather block_size points at a time and cast row_block_size
+    rows of W at a time, only keeping the activation of the class, of its
+    runner up and the largest absolute activation at each point, so that
+    neither W nor the (K, C) activations are copied in float64.
+    With rtol > 0 the class must beat the runner up by rtol times the
+    largest absolute activation."""
+    class_idxs = np.asarray(class_idxs, dtype=np.int64)
+    num_classes = W.shape[0]
+    valid = np.zeros(len(class_idxs), dtype=bool)
+    for start in range(0, len(class_idxs), block_size):
+        cols = class_idxs[start:start + block_size]
+        block = np.array([np.asarray(point, dtype=np.float64).ravel()
+                          for point in points[start:start + block_size]]).T
+        k = np.arange(len(cols))
+        top = np.empty(len(cols))
+        runner_up = np.full(len(cols), -np.inf)
+        scale = np.zeros(len(cols))
+        for row_start in range(0, num_classes, row_block_size):
+            rows = W[row_start:row_start + row_block_size].astype(np.float64, copy=False)
+            act = rows.dot(block)
+            if b is not None:
+                act += b.ravel()[row_start:row_start + row_block_size].reshape(-1, 1)
+            scale = np.maximum(scale, np.abs(act).max(axis=0))
+            own = (cols >= row_start) & (cols < row_start + len(rows))
+            top[own] = act[cols[own] - row_start, k[own]]
+            act[cols[own] - row_start, k[own]] = -np.inf
+            runner_up = np.maximum(runner_up, act.max(axis=0))
+        valid[start:start + block_size] = in_bounds(block, lb, ub) & \
+            (top - runner_up > rtol * scale)
+    return valid
+
+
 class ApproxAlgorithms(Enum):
     # Braid Reflect algorithm
     braid_swap = 0
+    # Braid Reflect on blocks of classes at once (one GEMM per step)
+    braid_swap_batched = 1
+    # Braid Reflect with O(C) activation updates from cached Gram columns
+    braid_swap_gram = 3
+    # Braid Reflect with argmax that skips rows with small norm
+    braid_swap_pruned = 4
+    # Relaxation method using all violated braid constraints at each step
+    braid_relax = 5
     none = 2
 
     @classmethod
@@ -49,6 +335,18 @@ class ApproxAlgorithms(Enum):
     
 class ExactAlgorithms(Enum):
     lp_chebyshev = 2
+    # Chebyshev LP against extreme points found so far (Clarkson)
+    lp_clarkson = 4
+    # Vertices of the convex hull of W (lifted by b) using QHULL
+    qhull = 5
+    # lp_chebyshev reusing one warm started model per process
+    lp_chebyshev_warm = 6
+    # lp_chebyshev solved by HiGHS through scipy, no license needed
+    lp_highs = 7
+    # lp_chebyshev against a growing set of violated braid constraints
+    lp_active_set = 8
+    # Batched first order method, undecided classes go to lp_chebyshev
+    first_order = 9
     none = 3
 
     @classmethod
@@ -60,6 +358,44 @@ class ExactAlgorithms(Enum):
         return cl.choices()[-1]
 
 
+class StartingPoints(Enum):
+    # Weight vector of the class itself
+    weight = 0
+    # Weight vector minus the mean weight vector
+    centered = 1
+    # Weight vector projected off the dominant singular directions of W
+    deflated = 2
+    # Centered weight vector scaled to make up for a small bias
+    bias = 3
+
+    @classmethod
+    def choices(cl):
+        return [c.name for c in cl]
+
+    @classmethod
+    def default(cl):
+        return cl.choices()[0]
+
+
+class ProbePoints(Enum):
+    # Uniformly random points in the bounds
+    random = 0
+    # Weight vectors of random classes
+    weights = 1
+    # Midpoints between weight vectors of random pairs of classes
+    midpoints = 2
+    # Random corners of the bounds
+    signs = 3
+
+    @classmethod
+    def choices(cl):
+        return [c.name for c in cl]
+
+    @classmethod
+    def default(cl):
+        return cl.choices()
+
+
 class StolenProbabilitySearch(object):
     """Algorithm to detect whether it is possible to assign all classes
     the largest probability. 
@@ -69,6 +405,15 @@ class StolenProbabilitySearch(object):
         self.W = W
         self.num_classes, self.dim = self.W.shape
         self.num_processes = int(os.environ.get('STOLLEN_NUM_PROCESSES', 1))
+        # The exact stage uses as many processes as the approximate stage
+        # unless told otherwise, each solving LPs with this many threads
+        self.exact_num_processes = int(os.environ.get('STOLLEN_EXACT_NUM_PROCESSES', 0)) or None
+        self.exact_threads = int(os.environ.get('STOLLEN_EXACT_THREADS', 1))
+        # Number of classes advanced together by batched algorithms
+        self.batch_size = int(os.environ.get('STOLLEN_BATCH_SIZE', 64))
+        # Precision of the approximate stage, its witnesses are verified
+        # in float64 before we trust them
+        self.approx_dtype = np.dtype(os.environ.get('STOLLEN_APPROX_DTYPE', 'float32'))
 
         self.b = b
 
@@ -79,51 +424,467 @@ class StolenProbabilitySearch(object):
                              lb=LB,
                              ub=UB,
                              patience=100,
-                             num_processes=None):
-        global W, b, tW, tb
+                             num_processes=None,
+                             batch_size=None,
+                             exact_num_processes=None,
+                             exact_threads=None,
+                             stall_patience=None,
+                             starts=None,
+                             harvest=False,
+                             probes=None,
+                             num_probes=4096,
+                             optimize_radius=False,
+                             previous=None,
+                             near_duplicate_tol=None,
+                             approx_dtype=None,
+                             approx_rtol=APPROX_RTOL,
+                             certificates=False):
+        """previous are results of an earlier run, e.g. on an earlier
+        checkpoint of the same model. Classes whose witness or certificate
+        still holds for W and b are not searched again.
+        Classes whose weights are tied with another class are bounded and
+        are not searched, unless they have the largest bias among them.
+        If near_duplicate_tol is set, the results list the classes within
+        that distance of each class.
+        The approximate stage runs in approx_dtype. Its witnesses and
+        those of the probes are verified in float64, and classes whose witness does not beat the
+        runner up by approx_rtol of the largest activation go on to the
+        exact algorithm (marked as escalated).
+        If certificates is set, exact algorithms that can export one
+        attach a certificate to bounded classes, which previous can use."""
+        global W, b, tW, tb, CERTIFIED, LP_THREADS
 
         if class_list is None:
             class_list = tuple(range(self.num_classes))
 
         num_processes = num_processes or self.num_processes
+        batch_size = batch_size or self.batch_size
+        exact_num_processes = exact_num_processes or self.exact_num_processes or num_processes
+        exact_threads = exact_threads or self.exact_threads
+        approx_dtype = np.dtype(approx_dtype or self.approx_dtype)
 
         # List of classes to return
         results = []
 
-        # We assume our vectors span the column space (dim dimension)
-        S = np.linalg.svd(self.W, compute_uv=False)
-        rank = np.linalg.matrix_rank(self.W.astype(np.float64))
-        assert rank == min(self.dim, self.num_classes), 'Rank=%d, dim=%d' % (rank, self.dim)
-        # If we don't have at least dim + 2 weight vectors,
+        # If our vectors do not span the column space, the activations only
+        # depend on the component of the input in the row space of W
+        structure = self.precheck()
+        rank, basis = structure['rank'], structure['basis']
+        # The hull is computed in the row space too, lifted by a non
+        # constant bias, fail before the approximate stage rather than after it
+        if exact_algorithm is not None and \
+                ExactAlgorithms[exact_algorithm] == ExactAlgorithms.qhull:
+            hull_dim = rank + (self.b is not None and np.ptp(self.b) > 0)
+            if hull_dim > QHULL_MAX_DIM:
+                raise ValueError('QHULL is too slow for dim=%d (max %d)'
+                                 % (hull_dim, QHULL_MAX_DIM))
+        # If we don't have at least rank + 2 weight vectors,
         # there is no way to have one weight vector be internal
         # to the convex hull of the rest.
         # E.g. in dim=2 need 4 points - 3 points form a triangle,
         # need one more point to place it inside the triangle.
-        if self.num_classes < self.dim + 1:
+        if self.num_classes < rank + 1:
             return results
 
-        is_bounded = partial(class_is_bounded,
-                             shape=(self.num_classes, self.dim),
-                             dtype=self.W.dtype,
-                             approx_algorithm=approx_algorithm,
-                             exact_algorithm=exact_algorithm,
-                             lb=lb,
-                             ub=ub,
-                             patience=patience)
+        # Only search classes whose results from the previous run are broken
+        if previous:
+            start_time = time.time()
+            class_set = set(class_list)
+            rechecked = self.recheck([r for r in previous if r['index'] in class_set],
+                                     lb=lb, ub=ub)
+            recheck_time = (time.time() - start_time) / max(len(rechecked), 1)
+            for result in rechecked:
+                result['time_taken'] = recheck_time
+            results.extend(rechecked)
+            rechecked = set(result['index'] for result in rechecked)
+            class_list = tuple(c for c in class_list if c not in rechecked)
+
+        # Classes with the same weights differ by a constant everywhere, so
+        # only the class with the largest bias can be the argmax, and not
+        # even that one if the bias is tied too
+        start_time = time.time()
+        class_set = set(class_list)
+        duplicates = [group for group in duplicate_rows(self.W)
+                      if not class_set.isdisjoint(group.tolist())]
+        duplicate_time = (time.time() - start_time) / max(sum(map(len, duplicates)), 1)
+        for group in duplicates:
+            bias = self.b.ravel()[group] if self.b is not None else np.zeros(len(group))
+            winners = group[bias == bias.max()]
+            dominated = group if len(winners) > 1 else group[group != winners[0]]
+            for class_idx in dominated.tolist():
+                if class_idx in class_set:
+                    results.append(dict(index=class_idx,
+                                        is_bounded=True,
+                                        duplicates=[int(c) for c in group if c != class_idx],
+                                        iterations=0,
+                                        time_taken=duplicate_time))
+                    class_set.remove(class_idx)
+        class_list = tuple(c for c in class_list if c in class_set)
+
+        near = dict()
+        if near_duplicate_tol is not None:
+            near = near_duplicate_rows(dense_weights(self.W), self.b, tol=near_duplicate_tol)
+
+        # Cheaply find witnesses for many classes at once by checking which
+        # class is the argmax at a large number of probe points.
+        probed = dict()
+        if probes:
+            start_time = time.time()
+            witnesses = probe_witnesses(dense_weights(self.W), self.b, lb=lb, ub=ub,
+                                        probes=probes, num_probes=num_probes)
+            class_set = set(class_list)
+            probed = {k: v for k, v in witnesses.items() if k in class_set}
+            probe_time = (time.time() - start_time) / max(len(probed), 1)
+            for class_idx, point in probed.items():
+                results.append(dict(index=class_idx,
+                                    is_bounded=False,
+                                    point=point,
+                                    iterations=0,
+                                    probed=True,
+                                    time_taken=probe_time))
+            class_list = tuple(c for c in class_list if c not in probed)
+
+        # We run the search as a pipeline: the approximate algorithm checks
+        # all classes first, then only the classes it could not find a
+        # witness for go to the exact algorithm, which has its own pool.
+        # Batched algorithms process blocks of classes in each task
+        batched = approx_algorithm is not None and \
+            ApproxAlgorithms[approx_algorithm] == ApproxAlgorithms.braid_swap_batched
+        if batched:
+            tasks = [class_list[i:i + batch_size]
+                     for i in range(0, len(class_list), batch_size)]
+            check_fn = class_block_is_bounded
+        else:
+            tasks = class_list
+            check_fn = class_is_bounded
+
+        check_kwargs = dict(shape=(self.num_classes, rank),
+                            dtype=approx_dtype,
+                            approx_algorithm=approx_algorithm,
+                            exact_algorithm=None,
+                            lb=lb,
+                            ub=ub,
+                            patience=patience,
+                            stall_patience=stall_patience,
+                            starts=starts,
+                            optimize_radius=optimize_radius,
+                            certificates=certificates)
+        is_bounded = partial(check_fn, **check_kwargs)
 
         # Set global variables - they will be visible in threads
+        # The approximate algorithm reflects in the coordinates of the
+        # row space, which is smaller if W is rank deficient
         W = self.W
-        b = self.b
+        if isinstance(W, QuantizedWeights) and \
+                (starts is not None or approx_algorithm is None or
+                 ApproxAlgorithms[approx_algorithm] not in (ApproxAlgorithms.braid_swap,
+                                                            ApproxAlgorithms.braid_swap_batched)):
+            # Only braid reflect gets by with the rows and products of W
+            W = W.dequantize()
+        if basis is not None:
+            W = W.dot(basis.T)
+        W = W.astype(approx_dtype, copy=False)
+        b = self.b if self.b is None else self.b.astype(approx_dtype, copy=False)
+        # Do not pass caches built for a previous W on to the workers
+        W_CACHE.clear()
+        CERTIFIED = None
+        if harvest and approx_algorithm is not None:
+            # Every argmax along a trajectory gives us a witness for that
+            # class, flag them in shared memory so that workers skip them.
+            CERTIFIED = np.frombuffer(RawArray(ctypes.c_bool, self.num_classes),
+                                      dtype=np.bool_)
+            CERTIFIED[list(probed)] = True
+            CERTIFIED[[r['index'] for r in results if not r['is_bounded']]] = True
+
+        if approx_algorithm is not None:
+            # Use multiprocessing to parallelise search across weight vectors
+            # Each process checks if a particular class has stolen probability
+            with Pool(processes=num_processes) as p:
+                with tqdm(total=len(class_list), desc='Checking for stolen probability') as pbar:
+                    for i, result in enumerate(p.imap_unordered(is_bounded, tasks)):
+                        if batched:
+                            results.extend(result)
+                            pbar.update(len(result))
+                        else:
+                            results.append(result)
+                            pbar.update()
+        else:
+            results.extend(dict(index=class_idx, is_bounded=True) for class_idx in class_list)
+
+        if basis is not None:
+            results = [self.lift_result(result, basis, lb=lb, ub=ub) for result in results]
+        if CERTIFIED is not None:
+            results = self.fill_harvested(results, basis=basis, **check_kwargs)
+            CERTIFIED = None
+        results = self.escalate(results, lb=lb, ub=ub, rtol=approx_rtol)
+
+        if exact_algorithm is None:
+            return self.flag_near_duplicates(results, near)
+
+        # Exact algorithms work in the original coordinates and precision,
+        # with the box on the input rather than on its component in the
+        # row space
+        if W is not self.W or b is not self.b:
+            W = dense_weights(self.W)
+            b = self.b
+            W_CACHE.clear()
+
+        exact_enum = ExactAlgorithms[exact_algorithm]
+        # Certificates of rechecked classes already prove they are bounded,
+        # as do the classes tied with another class
+        undecided = [result['is_bounded'] and not result.get('rechecked')
+                     and 'duplicates' not in result for result in results]
+        candidates = [result for result, u in zip(results, undecided) if u]
+        results = [result for result, u in zip(results, undecided) if not u]
+        if exact_enum == ExactAlgorithms.qhull:
+            # Compute the hull once, workers inherit it through the cache
+            get_hull_witnesses(W, b)
+        elif exact_enum == ExactAlgorithms.lp_clarkson:
+            # Classes we have witnesses for are extreme points
+            get_extreme_points(W).update(result['index'] for result in results
+                                        if not result['is_bounded'])
+
+        # The batched exact algorithm processes blocks of classes in each task
+        block_size = batch_size if exact_enum == ExactAlgorithms.first_order else 1
+        exact_tasks = [candidates[i:i + block_size]
+                       for i in range(0, len(candidates), block_size)]
+        check_exactly = partial(exact_stage,
+                                approx_algorithm=approx_algorithm,
+                                exact_algorithm=exact_algorithm,
+                                lb=lb,
+                                ub=ub,
+                                optimize_radius=optimize_radius,
+                                certificates=certificates)
+        # Workers inherit the thread count, the caller gets its own back
+        previous_threads, LP_THREADS = LP_THREADS, exact_threads
+        try:
+            with Pool(processes=exact_num_processes) as p:
+                with tqdm(total=len(candidates), desc='Checking candidates exactly') as pbar:
+                    for result in p.imap_unordered(check_exactly, exact_tasks):
+                        results.extend(result)
+                        pbar.update(len(result))
+        finally:
+            LP_THREADS = previous_threads
+
+        return self.flag_near_duplicates(results, near)
+
+    def add_classes(self, W_new, b_new=None, previous=None, **kwargs):
+        """Append the rows W_new (and b_new) to the layer and return the
+        results for all classes, given the results previous for the
+        classes we had so far. New rows can only shrink the regions of the
+        old classes, so bounded classes stay bounded, and a witness stays
+        valid unless some new class beats the old one at it. We only
+        evaluate the new rows at the stored witness points and search the
+        classes whose witness broke and the new classes.
+        kwargs are passed on to find_bounded_classes."""
+        if isinstance(self.W, QuantizedWeights):
+            raise ValueError('Cannot add classes to quantized weights, '
+                             'quantize all rows and search again')
+        num_old = self.num_classes
+        W_new = np.asarray(W_new).reshape(-1, self.dim)
+        if self.b is not None or b_new is not None:
+            b_old = self.b if self.b is not None else np.zeros((num_old, 1))
+            b_new = np.asarray(b_new).reshape(-1, 1) if b_new is not None \
+                else np.zeros((len(W_new), 1))
+            b_new = b_new.astype(b_old.dtype)
+        kept = []
+        if previous:
+            kept = [dict(r) for r in previous if r['is_bounded']]
+            witnessed = [r for r in previous if not r['is_bounded'] and r.get('point') is not None]
+            if witnessed:
+                class_idxs = np.array([r['index'] for r in witnessed], dtype=np.int64)
+                points = np.array([np.asarray(r['point'], dtype=np.float64).ravel()
+                                   for r in witnessed]).T
+                # Activation of each class at its own witness point
+                top = np.einsum('ij,ji->i', self.W[class_idxs, :], points)
+                new_act = W_new.dot(points)
+                if self.b is not None:
+                    top += self.b.ravel()[class_idxs]
+                if b_new is not None:
+                    new_act += b_new.reshape(-1, 1)
+                # With no new rows every witness is still valid
+                valid = top > new_act.max(axis=0, initial=-np.inf)
+                kept.extend(dict(r) for r, v in zip(witnessed, valid) if v)
+        self.W = np.vstack([self.W, W_new.astype(self.W.dtype)])
+        if b_new is not None:
+            self.b = np.vstack([b_old, b_new])
+        self.num_classes = self.W.shape[0]
+
+        kept_idxs = set(r['index'] for r in kept)
+        class_list = [c for c in range(self.num_classes) if c not in kept_idxs]
+        results = self.find_bounded_classes(class_list=class_list, **kwargs) if class_list else []
+        return list(sorted(kept + results, key=lambda x: x['index']))
+
+    def recheck(self, previous, lb=LB, ub=UB):
+        """Returns the results in previous whose witness point (for classes
+        that are not bounded) or certificate (for bounded classes) is still
+        valid for our W and b, marked as rechecked."""
+        if lb is None:
+            lb = -np.inf
+        if ub is None:
+            ub = np.inf
+        witnessed = [r for r in previous if not r['is_bounded'] and r.get('point') is not None]
+        certified = [r for r in previous if r['is_bounded'] and r.get('certificate')]
+        rechecked = []
+        if witnessed:
+            valid = verify_witnesses([r['index'] for r in witnessed],
+                                     [r['point'] for r in witnessed],
+                                     self.W, self.b, lb=lb, ub=ub)
+            rechecked.extend(r for r, v in zip(witnessed, valid) if v)
+        if certified:
+            W = dense_weights(self.W)
+            certificates = [r['certificate'] for r in certified]
+            valid = verify_certificates([r['index'] for r in certified], certificates,
+                                        W, self.b, lb=lb, ub=ub)
+            # Without a bias the certificates hold with no slack, try to
+            # fix the weights on the same support before giving up
+            for k in np.flatnonzero(~valid):
+                certificate = repair_certificate(certified[k]['index'], certificates[k], W)
+                if verify_certificates([certified[k]['index']], [certificate],
+                                       W, self.b, lb=lb, ub=ub)[0]:
+                    certified[k] = dict(certified[k], certificate=certificate)
+                    valid[k] = True
+            rechecked.extend(r for r, v in zip(certified, valid) if v)
+        return [dict(index=r['index'],
+                     is_bounded=r['is_bounded'],
+                     rechecked=True,
+                     **({'certificate': r['certificate']} if r['is_bounded']
+                        else {'point': np.asarray(r['point'], dtype=np.float64).ravel()}))
+                for r in rechecked]
+
+    def flag_near_duplicates(self, results, near):
+        """Sort the results by class and list the near duplicates of each
+        class. Near duplicates can still differ in whether they are
+        bounded, so we only report them."""
+        for result in results:
+            if result['index'] in near:
+                result['near_duplicates'] = near[result['index']]
+        return list(sorted(results, key=lambda x: x['index']))
 
-        # Use multiprocessing to parallelise search across weight vectors
-        # Each process checks if a particular class has stolen probability
-        with Pool(processes=num_processes) as p:
-            with tqdm(total=len(class_list), desc='Checking for stolen probability') as pbar:
-                for i, result in enumerate(p.imap_unordered(is_bounded, class_list)):
-                    results.append(result)
-                    pbar.update()
+    def precheck(self):
+        """Returns a dict with the rank and condition number of W, its
+        singular values and a basis of its row space if W is rank
+        deficient. It is computed once per W, so calls on subsets of
+        classes through class_list do not repeat it."""
+        return precheck(self.W)
+
+    def lift_result(self, result, basis, lb=LB, ub=UB):
+        """Map the points of a result found in the coordinates of the row
+        space back to the input space. The box lb, ub is only checked in
+        the input space, by escalate."""
+        if result.get('probed') or result.get('rechecked'):
+            return result
+        if result.get('witnesses'):
+            result['witnesses'] = {idx: basis.T.dot(point)
+                                   for idx, point in result['witnesses'].items()}
+        if result.get('point') is not None:
+            point = np.asarray(result['point'])
+            result['point'] = basis.T.dot(point.reshape(len(basis), -1)).reshape(-1, *point.shape[1:])
+        return result
+
+    def escalate(self, results, lb=LB, ub=UB, rtol=APPROX_RTOL):
+        """Verify the witnesses of the probes and the approximate stage
+        against W and b in float64. Classes whose witness fails, or only
+        wins by less than rtol of the largest activation, are marked as
+        bounded (and escalated) so that the exact algorithm checks them.
+        Rechecked witnesses were already verified in float64."""
+        if lb is None:
+            lb = -np.inf
+        if ub is None:
+            ub = np.inf
+        witnessed = [r for r in results if not r['is_bounded'] and not r.get('rechecked')]
+        if not witnessed:
+            return results
+        valid = verify_witnesses([r['index'] for r in witnessed],
+                                 [r['point'] for r in witnessed],
+                                 self.W, self.b, lb=lb, ub=ub, rtol=rtol)
+        for k, r in enumerate(witnessed):
+            r['point'] = np.asarray(r['point'], dtype=np.float64)
+            if not valid[k]:
+                r['is_bounded'] = True
+                r['escalated'] = True
+        return results
+
+    def fill_harvested(self, results, basis=None, **check_kwargs):
+        """Attach witnesses found along trajectories to classes that
+        were skipped because of them."""
+        global CERTIFIED
+        witnesses = dict()
+        for result in results:
+            for idx, point in result.pop('witnesses', dict()).items():
+                witnesses.setdefault(idx, point)
+        filled = []
+        for result in results:
+            if result.get('harvested'):
+                point = witnesses.get(result['index'])
+                if point is not None and is_witness(result['index'], point, self.W, self.b,
+                                                    lb=check_kwargs['lb'], ub=check_kwargs['ub']):
+                    result['point'] = point
+                else:
+                    # Do not trust a witness we cannot verify, search again
+                    CERTIFIED = None
+                    result = class_is_bounded(result['index'], **check_kwargs)
+                    if basis is not None:
+                        result = self.lift_result(result, basis,
+                                                  lb=check_kwargs['lb'], ub=check_kwargs['ub'])
+            filled.append(result)
+        return filled
+
+
+def probe_points(W, lb=LB, ub=UB, probe=ProbePoints.random.name, num_probes=4096):
+    """Returns a (DIM, num_probes) matrix of probe points within bounds."""
+    num_classes, dim = W.shape
+    probe_enum = ProbePoints[probe]
+    if probe_enum == ProbePoints.random:
+        if np.isfinite(lb) and np.isfinite(ub):
+            points = np.random.uniform(lb, ub, (dim, num_probes))
+        else:
+            points = np.random.normal(0, 1, (dim, num_probes))
+    elif probe_enum == ProbePoints.weights:
+        rows = np.random.choice(num_classes, min(num_probes, num_classes), replace=False)
+        points = W[rows, :].T
+    elif probe_enum == ProbePoints.midpoints:
+        first = np.random.randint(num_classes, size=num_probes)
+        second = np.random.randint(num_classes, size=num_probes)
+        points = .5 * (W[first, :] + W[second, :]).T
+    elif probe_enum == ProbePoints.signs:
+        signs = np.random.randint(2, size=(dim, num_probes)).astype(bool)
+        lower = lb if np.isfinite(lb) else -1.
+        upper = ub if np.isfinite(ub) else 1.
+        points = np.where(signs, upper, lower)
+    else:
+        raise ValueError('Unknown probe points: "%s"' % probe)
+    return np.clip(points, lb, ub).astype(W.dtype)
 
-        return list(sorted(results, key=lambda x: x['index']))
+
+def probe_witnesses(W, b=None, lb=LB, ub=UB, probes=ProbePoints.default(),
+                    num_probes=4096, block_size=1024):
+    """Evaluate the activations at probe points in blocks and keep a
+    witness for each class that is the unique argmax at some probe.
+    Returns a dictionary from class index to witness point."""
+    if lb is None:
+        lb = -np.inf
+    if ub is None:
+        ub = np.inf
+    witnesses = dict()
+    for probe in probes:
+        points = probe_points(W, lb=lb, ub=ub, probe=probe, num_probes=num_probes)
+        for start in range(0, points.shape[1], block_size):
+            block = points[:, start:start + block_size]
+            # Activations are (probes, classes) such that the reductions
+            # over classes below are over contiguous memory.
+            act = block.T.dot(W.T)
+            if b is not None:
+                act += b.reshape(1, -1)
+            rows = np.arange(act.shape[0])
+            argmax = np.argmax(act, axis=1)
+            top = act[rows, argmax]
+            # Ties do not count - the argmax needs to be strictly largest
+            act[rows, argmax] = -np.inf
+            unique = top > act.max(axis=1)
+            for k in np.flatnonzero(unique):
+                witnesses.setdefault(int(argmax[k]), block[:, k].copy())
+    return witnesses
 
 
 def class_is_bounded(class_idx,
@@ -133,40 +894,316 @@ def class_is_bounded(class_idx,
                      exact_algorithm=None,
                      lb=LB,
                      ub=UB,
-                     patience=100):
+                     patience=100,
+                     stall_patience=None,
+                     starts=None,
+                     optimize_radius=False,
+                     certificates=False):
 
     start_time = time.time()
-    result = dict()
     approx_result = dict()
-    exact_result = dict()
-
-    num_classes, dim = shape
 
     if lb is None:
         lb = -np.inf
     if ub is None:
         ub = np.inf
 
+    recorder = None
+    if CERTIFIED is not None:
+        if CERTIFIED[class_idx]:
+            return harvested_result(class_idx, start_time)
+        recorder = WitnessRecorder(lb=lb, ub=ub)
+
     assert (approx_algorithm is not None) or (exact_algorithm is not None)
     # NOTE: In approx method we do not include bias for time being as faster.
     # This can mean more false positives - but we can discard those with
     # exact method
     if approx_algorithm is not None:
-        approx_enum = ApproxAlgorithms[approx_algorithm]
-        if approx_enum == ApproxAlgorithms.braid_swap:
-            approx_result = candidate_is_bounded(class_idx, W, b=b, lb=lb, ub=ub, patience=patience)
-        else:
-            raise ValueError('Unknown approximate algorithm: "%s"' % approx_algorithm)
-
-    if exact_algorithm is not None:
-        if approx_algorithm is None or approx_result['is_bounded']:
-            exact_enum = ExactAlgorithms[exact_algorithm]
-            if exact_enum == ExactAlgorithms.lp_chebyshev:
-                # This takes bias term into account
-                exact_result = lp_chebyshev(class_idx, W, b, lb=lb, ub=ub)
-            else:
-                raise ValueError('Unknown exact algorithm: "%s"'
-                                 % exact_algorithm)
+        approx_result = approx_is_bounded(class_idx, approx_algorithm, lb=lb, ub=ub,
+                                          patience=patience,
+                                          stall_patience=stall_patience,
+                                          starts=starts,
+                                          recorder=recorder)
+        if recorder is not None:
+            approx_result['witnesses'] = recorder.witnesses
+
+    result = complete_result(class_idx, approx_result,
+                             approx_algorithm=approx_algorithm,
+                             exact_algorithm=exact_algorithm,
+                             lb=lb,
+                             ub=ub,
+                             optimize_radius=optimize_radius,
+                             certificates=certificates)
+
+    end_time = time.time()
+    result['time_taken'] = end_time - start_time
+
+    return result
+
+
+def approx_is_bounded(class_idx,
+                      approx_algorithm,
+                      lb=LB,
+                      ub=UB,
+                      patience=100,
+                      stall_patience=None,
+                      starts=None,
+                      recorder=None):
+    """Dispatch to the approximate algorithm."""
+    approx_enum = ApproxAlgorithms[approx_algorithm]
+    if starts is not None and approx_enum in (ApproxAlgorithms.braid_swap,
+                                              ApproxAlgorithms.braid_swap_batched):
+        # Multiple starting points are run as a block
+        approx_result = candidates_are_bounded_multistart([class_idx], W, b=b, lb=lb, ub=ub,
+                                                          patience=patience,
+                                                          stall_patience=stall_patience,
+                                                          starts=starts,
+                                                          recorder=recorder)[0]
+    elif starts is not None:
+        raise ValueError('Starting points not supported by "%s"' % approx_algorithm)
+    elif approx_enum == ApproxAlgorithms.braid_swap:
+        approx_result = candidate_is_bounded(class_idx, W, b=b, lb=lb, ub=ub, patience=patience,
+                                             stall_patience=stall_patience,
+                                             recorder=recorder)
+    elif approx_enum == ApproxAlgorithms.braid_swap_batched:
+        approx_result = candidates_are_bounded([class_idx], W, b=b, lb=lb, ub=ub, patience=patience,
+                                               stall_patience=stall_patience,
+                                               recorder=recorder)[0]
+    elif approx_enum == ApproxAlgorithms.braid_swap_gram:
+        approx_result = candidate_is_bounded_gram(class_idx, W, b=b, lb=lb, ub=ub, patience=patience,
+                                                  stall_patience=stall_patience,
+                                                  recorder=recorder)
+    elif approx_enum == ApproxAlgorithms.braid_swap_pruned:
+        approx_result = candidate_is_bounded(class_idx, W, b=b, lb=lb, ub=ub, patience=patience,
+                                             index=get_norm_index(W, b),
+                                             stall_patience=stall_patience,
+                                             recorder=recorder)
+    elif approx_enum == ApproxAlgorithms.braid_relax:
+        approx_result = candidate_is_bounded_relax(class_idx, W, b=b, lb=lb, ub=ub, patience=patience,
+                                                   stall_patience=stall_patience,
+                                                   recorder=recorder)
+    else:
+        raise ValueError('Unknown approximate algorithm: "%s"' % approx_algorithm)
+    return approx_result
+
+
+def class_block_is_bounded(class_idxs,
+                           shape,
+                           dtype,
+                           approx_algorithm,
+                           exact_algorithm=None,
+                           lb=LB,
+                           ub=UB,
+                           patience=100,
+                           stall_patience=None,
+                           starts=None,
+                           optimize_radius=False,
+                           certificates=False):
+    """Same as class_is_bounded, but for a block of classes that are
+    searched together by the batched approximate algorithm, or checked
+    together by the batched exact algorithm."""
+
+    start_time = time.time()
+
+    if lb is None:
+        lb = -np.inf
+    if ub is None:
+        ub = np.inf
+
+    results = []
+    recorder = None
+    if CERTIFIED is not None:
+        results = [harvested_result(class_idx, start_time)
+                   for class_idx in class_idxs if CERTIFIED[class_idx]]
+        class_idxs = [class_idx for class_idx in class_idxs if not CERTIFIED[class_idx]]
+        if not class_idxs:
+            return results
+        recorder = WitnessRecorder(lb=lb, ub=ub)
+
+    approx_enum = approx_algorithm and ApproxAlgorithms[approx_algorithm]
+    if approx_algorithm is None:
+        approx_results = [dict() for class_idx in class_idxs]
+    elif approx_enum == ApproxAlgorithms.braid_swap_batched and starts is not None:
+        approx_results = candidates_are_bounded_multistart(class_idxs, W, b=b, lb=lb, ub=ub,
+                                                           patience=patience,
+                                                           stall_patience=stall_patience,
+                                                           starts=starts,
+                                                           recorder=recorder)
+    elif approx_enum == ApproxAlgorithms.braid_swap_batched:
+        approx_results = candidates_are_bounded(class_idxs, W, b=b, lb=lb, ub=ub, patience=patience,
+                                                stall_patience=stall_patience,
+                                                recorder=recorder)
+    else:
+        approx_results = [approx_is_bounded(class_idx, approx_algorithm, lb=lb, ub=ub,
+                                            patience=patience,
+                                            stall_patience=stall_patience,
+                                            starts=starts,
+                                            recorder=recorder)
+                          for class_idx in class_idxs]
+    if recorder is not None:
+        approx_results[0]['witnesses'] = recorder.witnesses
+
+    # Time for the approximate stage is shared equally across the block
+    approx_time = (time.time() - start_time) / len(class_idxs)
+
+    results.extend(complete_results(class_idxs, approx_results,
+                                    approx_algorithm=approx_algorithm,
+                                    exact_algorithm=exact_algorithm,
+                                    lb=lb,
+                                    ub=ub,
+                                    optimize_radius=optimize_radius,
+                                    certificates=certificates))
+    for result in results[-len(class_idxs):]:
+        result['time_taken'] += approx_time
+
+    return results
+
+
+def exact_stage(approx_results,
+                approx_algorithm=None,
+                exact_algorithm=None,
+                lb=LB,
+                ub=UB,
+                optimize_radius=False,
+                certificates=False):
+    """Exact stage of find_bounded_classes for classes the approximate
+    stage could not find a witness for."""
+    if lb is None:
+        lb = -np.inf
+    if ub is None:
+        ub = np.inf
+    results = complete_results([result['index'] for result in approx_results],
+                               approx_results,
+                               approx_algorithm=approx_algorithm,
+                               exact_algorithm=exact_algorithm,
+                               lb=lb,
+                               ub=ub,
+                               optimize_radius=optimize_radius,
+                               certificates=certificates)
+    for result, approx_result in zip(results, approx_results):
+        result['time_taken'] += approx_result.get('time_taken', 0.)
+    return results
+
+
+def complete_results(class_idxs,
+                     approx_results,
+                     approx_algorithm=None,
+                     exact_algorithm=None,
+                     lb=LB,
+                     ub=UB,
+                     optimize_radius=False,
+                     certificates=False):
+    """complete_result for a block of classes, the batched exact
+    algorithm checks all of them at once. time_taken is the time
+    spent here."""
+    exact_results = dict()
+    exact_time = 0.
+    if exact_algorithm is not None and \
+            ExactAlgorithms[exact_algorithm] == ExactAlgorithms.first_order:
+        exact_start_time = time.time()
+        pending = [k for k, approx_result in enumerate(approx_results)
+                   if approx_algorithm is None or approx_result['is_bounded']]
+        if pending:
+            exact_results = dict(zip(pending, first_order_is_bounded(
+                [class_idxs[k] for k in pending], W, b, lb=lb, ub=ub,
+                optimize_radius=optimize_radius, certificates=certificates)))
+            exact_time = (time.time() - exact_start_time) / len(pending)
+
+    results = []
+    for k, (class_idx, approx_result) in enumerate(zip(class_idxs, approx_results)):
+        class_start_time = time.time()
+        result = complete_result(class_idx, approx_result,
+                                 approx_algorithm=approx_algorithm,
+                                 exact_algorithm=exact_algorithm,
+                                 lb=lb,
+                                 ub=ub,
+                                 optimize_radius=optimize_radius,
+                                 certificates=certificates,
+                                 exact_result=exact_results.get(k))
+        result['time_taken'] = time.time() - class_start_time
+        if k in exact_results:
+            result['time_taken'] += exact_time
+        results.append(result)
+
+    return results
+
+
+def harvested_result(class_idx, start_time):
+    """Result for a class we found a witness for while searching for
+    another class. The witness point is attached by the main process."""
+    return dict(index=class_idx,
+                is_bounded=False,
+                harvested=True,
+                iterations=0,
+                time_taken=time.time() - start_time)
+
+
+class WitnessRecorder(object):
+    """Keeps points along braid reflect trajectories at which some class
+    is the argmax, since they prove that the class is not bounded.
+    Recorded classes are flagged in CERTIFIED so that all processes
+    can skip searching for them."""
+    def __init__(self, lb=LB, ub=UB):
+        super(WitnessRecorder, self).__init__()
+        self.lb = lb
+        self.ub = ub
+        self.witnesses = dict()
+
+    def record(self, class_idx, point):
+        class_idx = int(class_idx)
+        if CERTIFIED[class_idx]:
+            return
+        point = point.reshape(-1, 1)
+        if in_bounds(point, self.lb, self.ub)[0]:
+            self.witnesses[class_idx] = point.ravel().copy()
+            CERTIFIED[class_idx] = True
+
+    def record_block(self, class_idxs, points):
+        """Record the argmax class_idxs[k] at the points[:, k] columns."""
+        new = np.flatnonzero(~CERTIFIED[class_idxs])
+        if len(new):
+            _, first = np.unique(class_idxs[new], return_index=True)
+            for k in new[first]:
+                self.record(class_idxs[k], points[:, k])
+
+
+def complete_result(class_idx,
+                    approx_result,
+                    approx_algorithm=None,
+                    exact_algorithm=None,
+                    lb=LB,
+                    ub=UB,
+                    optimize_radius=False,
+                    certificates=False,
+                    exact_result=None):
+    """Run the exact algorithm if the approximate one did not find a
+    solution and verify the solution if we found one.
+    Unless optimize_radius is set, exact LPs stop at the first point that
+    is a witness instead of maximising the Chebyshev radius.
+    If certificates is set, bounded classes get a verified certificate.
+    exact_result can be passed if a batched exact algorithm already
+    checked the class."""
+    result = dict()
+
+    if exact_result is None:
+        exact_result = dict()
+        if exact_algorithm is not None and \
+                (approx_algorithm is None or approx_result['is_bounded']):
+            exact_result = exact_is_bounded(class_idx, approx_result, exact_algorithm,
+                                            lb=lb, ub=ub, optimize_radius=optimize_radius,
+                                            certificates=certificates)
+    if exact_result and not optimize_radius and not exact_result['is_bounded'] and \
+            not is_witness(class_idx, exact_result['point'], W, b, lb=lb, ub=ub):
+        # A point EPSILON inside the braid cone can be a tie in the
+        # precision of W, push it as far inside as possible instead
+        exact_result = exact_is_bounded(class_idx, approx_result, exact_algorithm,
+                                        lb=lb, ub=ub, optimize_radius=True,
+                                        certificates=certificates)
+    if exact_result.get('certificate') is not None and \
+            not verify_certificates([class_idx], [exact_result['certificate']], W, b,
+                                    lb=lb, ub=ub)[0]:
+        # Multipliers of the solver can be too inaccurate to check
+        exact_result['certificate'] = dual_certificate(class_idx, W, b, lb=lb, ub=ub)
 
     result.update(**approx_result)
     result.update(**exact_result)
@@ -180,14 +1217,79 @@ def class_is_bounded(class_idx,
             act = W.dot(result['point'])
         assert np.argmax(act.ravel()) == class_idx
 
-    end_time = time.time()
-    result['time_taken'] = end_time - start_time
-
     return result
 
 
-def lp_chebyshev(position, W, b=None, lb=LB, ub=UB):
-    """Linear programme that computes maximum bounded sphere."""
+def exact_is_bounded(class_idx,
+                     approx_result,
+                     exact_algorithm,
+                     lb=LB,
+                     ub=UB,
+                     optimize_radius=False,
+                     certificates=False):
+    """Dispatch to the exact algorithm."""
+    exact_enum = ExactAlgorithms[exact_algorithm]
+    if exact_enum == ExactAlgorithms.lp_chebyshev:
+        # This takes bias term into account
+        exact_result = lp_chebyshev(class_idx, W, b, lb=lb, ub=ub,
+                                    optimize_radius=optimize_radius,
+                                    certificates=certificates)
+    elif exact_enum == ExactAlgorithms.lp_clarkson:
+        exact_result = lp_clarkson(class_idx, W, b, lb=lb, ub=ub,
+                                   optimize_radius=optimize_radius,
+                                   certificates=certificates)
+    elif exact_enum == ExactAlgorithms.qhull:
+        exact_result = qhull_is_bounded(class_idx, W, b, lb=lb, ub=ub,
+                                        optimize_radius=optimize_radius,
+                                        certificates=certificates)
+    elif exact_enum == ExactAlgorithms.lp_chebyshev_warm:
+        exact_result = get_chebyshev_lp(W, b, lb=lb, ub=ub,
+                                        optimize_radius=optimize_radius,
+                                        certificates=certificates).solve(class_idx)
+    elif exact_enum == ExactAlgorithms.lp_highs:
+        exact_result = get_highs_lp(W, b, lb=lb, ub=ub,
+                                    optimize_radius=optimize_radius).solve(class_idx)
+    elif exact_enum == ExactAlgorithms.lp_active_set:
+        exact_result = lp_active_set(class_idx, W, b, lb=lb, ub=ub,
+                                     point=approx_result.get('point'),
+                                     optimize_radius=optimize_radius,
+                                     certificates=certificates)
+    elif exact_enum == ExactAlgorithms.first_order:
+        exact_result = first_order_is_bounded([class_idx], W, b, lb=lb, ub=ub,
+                                              optimize_radius=optimize_radius,
+                                              certificates=certificates)[0]
+    else:
+        raise ValueError('Unknown exact algorithm: "%s"'
+                         % exact_algorithm)
+    return exact_result
+
+
+def braid_norms(W, position, out=None):
+    """Norms of the rows of W - W[position], computed from the cached
+    row norms and a single matrix vector product instead of a C x d
+    temporary."""
+    sq_norms = get_row_sq_norms(W)
+    if out is None:
+        out = np.empty(W.shape[0])
+    np.multiply(W.dot(W[position, :]), -2., out=out)
+    out += sq_norms
+    out += sq_norms[position]
+    # Cancellation can leave tiny negative values for near duplicates
+    np.maximum(out, 0., out=out)
+    out[position] = 0.
+    return np.sqrt(out, out=out)
+
+
+def lp_chebyshev(position, W, b=None, lb=LB, ub=UB, competitors=None, optimize_radius=False,
+                 certificates=False):
+    """Linear programme that computes maximum bounded sphere.
+    If competitors is given, only the braid constraints against these
+    classes are added to the LP. Unless optimize_radius is set we only
+    solve for feasibility with radius EPSILON, since any feasible point
+    is a witness.
+    If certificates is set, bounded classes get a certificate from the
+    Farkas multipliers. Barrier does not provide them, so we then solve
+    with dual simplex instead."""
 
     assert lb < ub
     assert lb != -np.inf
@@ -195,19 +1297,34 @@ def lp_chebyshev(position, W, b=None, lb=LB, ub=UB):
     num_classes, dim = W.shape
     EPSILON = 1e-8
 
+    # Buffers are allocated once per process and reused for every class
+    braid_buffer, cheby_buffer, braid_b_buffer = cached_for(
+        W, 'lp_buffers', lambda: (np.empty_like(W),
+                                  np.empty(num_classes),
+                                  np.empty(num_classes)))
+    cheby = braid_norms(W, position, out=cheby_buffer)
+
     # NOTE: For LP we want the halfspace defined by <= 0
     # So we subtract position from rest
-    braid = W - W[position, :]
-    braid = np.delete(braid, position, axis=0)
-
-    if b is not None:
-        braid_b = b - b[position]
-        braid_b = np.delete(braid_b, position, axis=0)
-        braid_b = braid_b.ravel()
+    if competitors is None:
+        # The row of the class itself is zero, 0 <= 0 is harmless
+        braid = np.subtract(W, W[position, :], out=braid_buffer)
+        if b is not None:
+            braid_b = np.subtract(b.ravel(), b.ravel()[position], out=braid_b_buffer)
+        else:
+            braid_b = braid_b_buffer
+            braid_b[:] = 0.
     else:
-        braid_b = np.zeros(num_classes - 1)
-
-    c = np.zeros(dim)
+        competitors = np.asarray(competitors, dtype=np.int64)
+        competitors = competitors[competitors != position]
+        num_competitors = len(competitors)
+        braid = np.take(W, competitors, axis=0, out=braid_buffer[:num_competitors])
+        braid -= W[position, :]
+        cheby = cheby[competitors]
+        if b is not None:
+            braid_b = b.ravel()[competitors] - b.ravel()[position]
+        else:
+            braid_b = np.zeros(num_competitors)
 
     # lp = linprog(c, A_ub=braid, b_ub=braid_b, bounds=(None, None), method='highs-ipm')
     # lp = linprog(c, A_ub=braid, b_ub=braid_b, bounds=(None, None))
@@ -217,20 +1334,23 @@ def lp_chebyshev(position, W, b=None, lb=LB, ub=UB):
     m = gp.Model('m')
     m.setParam('OutputFlag', 0)
     # m.setParam('Presolve', 1)
-    m.setParam('Method', 2)
+    # Barrier is fastest, but only dual simplex gives Farkas multipliers
+    m.setParam('Method', 1 if certificates else 2)
     # Radius lower bound is above this
     m.setParam('FeasibilityTol', EPSILON *.1)
-    m.params.threads = 1
+    if certificates:
+        # Farkas multipliers certify that the class is bounded
+        m.setParam('InfUnbdInfo', 1)
+    m.params.threads = LP_THREADS
     # NOTE: We need to specify ub and lb here otherwise there are definitely
     # unbounded regions.
     x = m.addMVar(lb=lb, ub=ub, shape=dim, name='xx')
 
     r = m.addMVar(lb=EPSILON, shape=1, name='r')
     # Add Chebyshev column
-    cheby = np.linalg.norm(braid, axis=1, keepdims=True)
-
-    m.addConstr(braid @ x + cheby @ r <= -braid_b, name='cc')
-    m.setObjective(r, GRB.MAXIMIZE)
+    cc = m.addConstr(braid @ x + cheby.reshape(-1, 1) @ r <= -braid_b, name='cc')
+    if optimize_radius:
+        m.setObjective(r, GRB.MAXIMIZE)
     m.update()
 
     try:
@@ -240,23 +1360,649 @@ def lp_chebyshev(position, W, b=None, lb=LB, ub=UB):
     # If we find a feasible solution, class is not bounded.
     if m.status == GRB.OPTIMAL:
         is_bounded = False
-        var_names = ['xx[%d]' % i for i in range(dim)]
-        point = np.array([m.getVarByName(n).X for n in var_names],
-                         dtype=np.float64)
-
         result = dict(is_bounded=is_bounded,
                       status=m.status,
-                      point=point,
-                      radius=getattr(m, 'objval', None))
+                      point=np.array(x.X, dtype=np.float64),
+                      radius=float(r.X[0]))
     else:
         is_bounded = True
         result = dict(is_bounded=is_bounded,
                       status=m.status,
                       radius=getattr(m, 'objval', None))
+        if certificates:
+            if competitors is None:
+                competitors = np.arange(num_classes)
+            try:
+                result['certificate'] = farkas_certificate(cc.FarkasDual, competitors, position)
+            except gp.GurobiError:
+                pass
     return result
 
 
-def candidate_is_bounded(candidate_idx, W, b=None, lb=LB, ub=UB, patience=100):
+def farkas_certificate(duals, competitors, position):
+    """Certificate that a class is bounded from the Farkas multipliers
+    of the braid constraints, see verify_certificates."""
+    weights = np.abs(duals)
+    keep = (weights > 0) & (competitors != position)
+    return dict(indices=competitors[keep].tolist(),
+                weights=weights[keep].tolist())
+
+
+class ChebyshevLP(object):
+    """Same LP as lp_chebyshev, but the Gurobi environment and model are
+    built once and reused for all classes checked by a process.
+    We add a variable t = W[position] x + b[position], such that the
+    braid constraints become W x - t + ||W - W[position]|| r <= -b.
+    Only the row defining t and the Chebyshev column r change from class
+    to class, so the dual simplex can warm start from the last basis."""
+    EPSILON = 1e-8
+
+    def __init__(self, W, b=None, lb=LB, ub=UB, optimize_radius=False, certificates=False):
+        super(ChebyshevLP, self).__init__()
+        self.optimize_radius = optimize_radius
+        self.certificates = certificates
+        assert lb < ub
+        assert lb != -np.inf
+        assert ub != np.inf
+        self.W = W
+        num_classes, dim = W.shape
+        if b is not None:
+            self.b = b.ravel()
+        else:
+            self.b = np.zeros(num_classes)
+
+        self.env = gp.Env(empty=True)
+        self.env.setParam('OutputFlag', 0)
+        self.env.start()
+        m = gp.Model('m', env=self.env)
+        # Dual simplex can warm start after we change the model
+        m.setParam('Method', 1)
+        # Radius lower bound is above this
+        m.setParam('FeasibilityTol', self.EPSILON * .1)
+        if certificates:
+            # Farkas multipliers certify that the class is bounded
+            m.setParam('InfUnbdInfo', 1)
+        m.params.threads = LP_THREADS
+        x = m.addMVar(lb=lb, ub=ub, shape=dim, name='xx')
+        t = m.addMVar(lb=-GRB.INFINITY, shape=1, name='t')
+        m.addConstr(W @ x - np.ones((num_classes, 1)) @ t <= -self.b, name='cc')
+        m.ModelSense = GRB.MAXIMIZE
+        m.update()
+
+        self.m = m
+        self.x = x
+        variables = m.getVars()
+        self.x_vars = variables[:dim]
+        self.t_var = variables[dim]
+        self.braid_constrs = m.getConstrs()
+        self.r = None
+        self.t_constr = None
+
+    def solve(self, position):
+        m = self.m
+        if self.r is not None:
+            m.remove(self.r)
+            m.remove(self.t_constr)
+        w = self.W[position, :]
+        # Add Chebyshev column
+        cheby = braid_norms(self.W, position)
+        self.r = m.addVar(lb=self.EPSILON, obj=float(self.optimize_radius), name='r',
+                          column=gp.Column(cheby.tolist(), self.braid_constrs))
+        self.t_constr = m.addConstr(gp.LinExpr((-w).tolist(), self.x_vars) + self.t_var
+                                    == self.b[position], name='t')
+        m.update()
+
+        try:
+            m.optimize()
+        except Exception as e:
+            print(e)
+        # If we find a feasible solution, class is not bounded.
+        if m.status == GRB.OPTIMAL:
+            result = dict(is_bounded=False,
+                          status=m.status,
+                          point=np.array(self.x.X, dtype=np.float64),
+                          radius=self.r.X)
+        else:
+            result = dict(is_bounded=True,
+                          status=m.status,
+                          radius=None)
+            if self.certificates:
+                try:
+                    duals = np.array(m.getAttr('FarkasDual', self.braid_constrs))
+                    result['certificate'] = farkas_certificate(duals, np.arange(len(duals)),
+                                                               position)
+                except gp.GurobiError:
+                    pass
+        return result
+
+
+def get_chebyshev_lp(W, b=None, lb=LB, ub=UB, optimize_radius=False, certificates=False):
+    key = ('chebyshev_lp', id(b), lb, ub, optimize_radius, certificates)
+    return cached_for(W, key, partial(ChebyshevLP, W, b, lb=lb, ub=ub,
+                                      optimize_radius=optimize_radius,
+                                      certificates=certificates))
+
+
+class HighsChebyshevLP(object):
+    """Same LP as ChebyshevLP, solved with HiGHS through scipy's linprog.
+    The sparse constraint matrix [W, -1, ||W - W[position]||] is built
+    once, for each class we only overwrite the Chebyshev column in place
+    and pass the row defining t as an equality constraint.
+    NOTE: Only our copy of the constraints is reused, linprog still builds
+    and presolves a new HiGHS model on every call, so there is no warm
+    start as with ChebyshevLP."""
+    EPSILON = 1e-8
+
+    def __init__(self, W, b=None, lb=LB, ub=UB, optimize_radius=False):
+        super(HighsChebyshevLP, self).__init__()
+        assert lb < ub
+        assert lb != -np.inf
+        assert ub != np.inf
+        self.W = W
+        num_classes, dim = W.shape
+        if b is not None:
+            self.b = b.ravel()
+        else:
+            self.b = np.zeros(num_classes)
+        # Chebyshev column starts as ones so that all its entries are stored
+        self.A_ub = csc_matrix(np.hstack([W,
+                                          -np.ones((num_classes, 1)),
+                                          np.ones((num_classes, 1))]))
+        self.cheby = self.A_ub.data[self.A_ub.indptr[-2]:self.A_ub.indptr[-1]]
+        self.b_ub = -self.b
+        self.c = np.zeros(dim + 2)
+        if optimize_radius:
+            # Maximise r
+            self.c[-1] = -1.
+        self.bounds = [(lb, ub)] * dim + [(None, None), (self.EPSILON, None)]
+
+    def solve(self, position):
+        w = self.W[position, :]
+        braid_norms(self.W, position, out=self.cheby)
+        A_eq = np.hstack([-w, 1., 0.]).reshape(1, -1)
+        b_eq = self.b[position:position + 1]
+        lp = linprog(self.c, A_ub=self.A_ub, b_ub=self.b_ub,
+                     A_eq=A_eq, b_eq=b_eq,
+                     bounds=self.bounds, method='highs',
+                     # Radius lower bound is above this
+                     options=dict(primal_feasibility_tolerance=self.EPSILON * .1))
+        # If we find a feasible solution, class is not bounded.
+        if lp.status == 0:
+            result = dict(is_bounded=False,
+                          status=lp.status,
+                          point=np.array(lp.x[:-2], dtype=np.float64),
+                          radius=lp.x[-1])
+        else:
+            result = dict(is_bounded=True,
+                          status=lp.status,
+                          radius=None)
+        return result
+
+
+def get_highs_lp(W, b=None, lb=LB, ub=UB, optimize_radius=False):
+    key = ('highs_lp', id(b), lb, ub, optimize_radius)
+    return cached_for(W, key, partial(HighsChebyshevLP, W, b, lb=lb, ub=ub,
+                                      optimize_radius=optimize_radius))
+
+
+def get_extreme_points(W):
+    """Per process set of classes known to be extreme points, i.e.
+    classes we found witnesses for."""
+    return cached_for(W, 'extreme_points', set)
+
+
+def lp_clarkson(position, W, b=None, lb=LB, ub=UB, optimize_radius=False, certificates=False):
+    """Output sensitive version of lp_chebyshev (Clarkson's algorithm).
+    We solve the LP only against the classes known to be extreme points.
+    If that LP is infeasible, so is the LP against all classes and the
+    class is bounded. Otherwise the class that is the argmax at the LP
+    solution is a new extreme point - we add it and solve again until
+    the class itself is the argmax.
+    The set of extreme points is shared by all classes checked by this
+    process, so most LPs only have as many constraints as there are
+    argmaxable classes."""
+    extreme_points = get_extreme_points(W)
+    result = dict(is_bounded=False, status=None, point=W[position, :].copy(), radius=None)
+    num_lps = 0
+    while True:
+        point = result['point']
+        if is_witness(position, point, W, b, lb=lb, ub=ub):
+            extreme_points.add(position)
+            break
+        act = W.dot(point)
+        if b is not None:
+            act += b.ravel()
+        argmax = np.argmax(act)
+        if argmax in extreme_points or argmax == position:
+            # Numerical trouble, the LP should have ruled this out
+            result = lp_chebyshev(position, W, b, lb=lb, ub=ub,
+                                  optimize_radius=optimize_radius,
+                                  certificates=certificates)
+            num_lps += 1
+            break
+        extreme_points.add(argmax)
+        competitors = np.fromiter(extreme_points, dtype=np.int64)
+        result = lp_chebyshev(position, W, b, lb=lb, ub=ub, competitors=competitors,
+                              optimize_radius=optimize_radius,
+                              certificates=certificates)
+        num_lps += 1
+        if result['is_bounded']:
+            break
+    result['num_lps'] = num_lps
+    result['num_extreme_points'] = len(extreme_points)
+    return result
+
+
+def lp_active_set(position, W, b=None, lb=LB, ub=UB, point=None, k=ACTIVE_SET_SIZE,
+                  optimize_radius=False, certificates=False):
+    """Cutting plane version of lp_chebyshev.
+    We start from the k competitors with the largest activation at point
+    (e.g. where the approximate algorithm gave up) and solve the LP
+    against those only. If that LP is infeasible the class is bounded,
+    otherwise we add the competitors that beat the class at the LP
+    solution (at most k of them, the largest first) and solve again."""
+    num_classes, dim = W.shape
+    if point is None:
+        point = W[position, :]
+    point = np.clip(point, lb, ub)
+    active = np.zeros(num_classes, dtype=bool)
+    active[position] = True
+    num_lps = 0
+    while True:
+        act = W.dot(point)
+        if b is not None:
+            act += b.ravel()
+        target = act[position]
+        # Competitors not in the LP yet that are at least as large as the class
+        act[active] = -np.inf
+        if num_lps == 0:
+            violated = np.flatnonzero(~active)
+        else:
+            violated = np.flatnonzero(act >= target)
+            if len(violated) == 0:
+                break
+        if len(violated) > k:
+            violated = violated[np.argpartition(act[violated], -k)[-k:]]
+        active[violated] = True
+        result = lp_chebyshev(position, W, b, lb=lb, ub=ub,
+                              competitors=np.flatnonzero(active),
+                              optimize_radius=optimize_radius,
+                              certificates=certificates)
+        num_lps += 1
+        if result['is_bounded']:
+            break
+        point = result['point']
+    result['num_lps'] = num_lps
+    result['num_constraints'] = int(active.sum()) - 1
+    return result
+
+
+def first_order_chebyshev(class_idxs, W, b=None, lb=LB, ub=UB, points=None,
+                          iterations=300, smoothing=1e-2, check_every=25, EPSILON=1e-8,
+                          certificates=False):
+    """Batched first order method for the Chebyshev LP of many classes.
+    For each class i we do projected gradient ascent on a smoothed minimum
+    over j of the braid margins (a_i(x) - a_j(x)) / ||W_i - W_j||, where
+    a(x) = W x + b. All classes of the block are updated together with
+    two C x k matrix products per step.
+    A class is not bounded as soon as it is the argmax at its point. The
+    softmin weights averaged over the steps estimate the LP dual, which
+    proves the class is bounded if the largest value over the box of the
+    combined braid constraints is below 0 (see dual_bounds).
+    Returns one result per class, with is_bounded None if we could not
+    decide either way. If certificates is set, bounded classes get the
+    sparsified dual weights as a certificate."""
+    class_idxs = np.asarray(class_idxs, dtype=np.int64)
+    num_classes, dim = W.shape
+    num_candidates = len(class_idxs)
+    cols = np.arange(num_candidates)
+    if b is not None:
+        bias = b.ravel()
+    else:
+        bias = cached_for(W, 'zero_bias', lambda: np.zeros(num_classes))
+
+    WC = W[class_idxs, :]
+    # Norms of the braid normals for all competitors of all candidates
+    sq_norms = get_row_sq_norms(W)
+    norms = sq_norms.reshape(-1, 1) + sq_norms[class_idxs] - 2 * W.dot(WC.T)
+    np.maximum(norms, 0., out=norms)
+    np.sqrt(norms, out=norms)
+    norms[class_idxs, cols] = np.inf
+    # Exact duplicates have no braid normal, their margin only depends on b
+    norms[norms == 0.] = EPSILON
+
+    if points is None:
+        points = WC.T.copy()
+        if lb < 0 < ub:
+            # Same scaling as for the QHULL witnesses
+            points *= .5 * min(ub, -lb) / np.abs(points).max(axis=0)
+    points = np.clip(points, lb, ub)
+    step = .1 * min(ub - lb, 2 * np.abs(points).max())
+
+    results = [dict(is_bounded=None, first_order_iterations=iterations) for c in class_idxs]
+    weights = np.zeros((num_classes, num_candidates))
+    active = np.ones(num_candidates, dtype=bool)
+    for it in range(iterations):
+        act = np.flatnonzero(active)
+        if not len(act):
+            break
+        X = points[:, act]
+        A = W.dot(X) + bias.reshape(-1, 1)
+        rows = class_idxs[act], np.arange(len(act))
+        margins = (A[rows] - A) / norms[:, act]
+        margins[rows] = np.inf
+        margin = margins.min(axis=0)
+        for k in act[margin > 0]:
+            if is_witness(class_idxs[k], points[:, k], W, b, lb=lb, ub=ub):
+                results[k] = dict(is_bounded=False,
+                                  point=points[:, k].copy(),
+                                  radius=float(margin[act == k][0]),
+                                  first_order_iterations=it)
+                active[k] = False
+        # Softmin weights, temperature shrinks with the step
+        temperature = smoothing * step / np.sqrt(it + 1)
+        P = np.exp(-(margins - margin) / temperature)
+        P /= P.sum(axis=0)
+        weights[:, act] += P
+        # Gradient of sum_j P_j (a_i - a_j) / ||W_i - W_j||
+        Q = P / norms[:, act]
+        grad = WC[act].T * Q.sum(axis=0) - W.T.dot(Q)
+        grad /= np.maximum(np.linalg.norm(grad, axis=0), EPSILON)
+        points[:, act] = np.clip(X + step / np.sqrt(it + 1) * grad, lb, ub)
+
+        if (it + 1) % check_every == 0 or it + 1 == iterations:
+            act = np.flatnonzero(active)
+            # Weights on the normalised margins, as weights on a_i - a_j
+            lam = weights[:, act] / norms[:, act]
+            bounds = dual_bounds(class_idxs[act], lam, W, b, lb=lb, ub=ub, EPSILON=EPSILON)
+            for j, (k, bound) in enumerate(zip(act, bounds)):
+                if bound < 0:
+                    results[k] = dict(is_bounded=True, dual_bound=float(bound),
+                                      first_order_iterations=it + 1)
+                    if certificates:
+                        results[k]['certificate'] = sparse_certificate(class_idxs[k], lam[:, j],
+                                                                       W, b, lb=lb, ub=ub)
+                    active[k] = False
+
+    # Polish the dual weights on their support, this is what usually
+    # proves classes in the interior of the hull without a bias are bounded.
+    # Classes of large layers go straight to the LP
+    support_sizes = [size for size in (2 * (dim + 1), 8 * (dim + 1), 32 * (dim + 1))
+                     if size <= POLISH_MAX_SUPPORT]
+    for k in np.flatnonzero(active):
+        for support_size in support_sizes:
+            lam = polish_dual(class_idxs[k], weights[:, k] / norms[:, k], W,
+                              support_size=support_size)
+            bound = dual_bounds(class_idxs[k:k + 1], lam.reshape(-1, 1), W, b,
+                                lb=lb, ub=ub, EPSILON=EPSILON)[0]
+            if bound < 0:
+                results[k] = dict(is_bounded=True, dual_bound=float(bound),
+                                  first_order_iterations=iterations)
+                if certificates:
+                    results[k]['certificate'] = sparse_certificate(class_idxs[k], lam,
+                                                                   W, b, lb=lb, ub=ub)
+                break
+            if support_size >= num_classes - 1:
+                break
+    return results
+
+
+def combined_constraint_max(class_idxs, lam, norms, W, b=None, lb=LB, ub=UB, EPSILON=1e-8):
+    """Maximum over the box of the combined braid constraint
+    sum_j lam_j (a_i(x) - a_j(x) - EPSILON ||W_i - W_j||) of each class,
+    for the columns of the dense or sparse (C, k) matrix of weights lam
+    summing to 1, given norms = sum_j lam_j ||W_i - W_j||. The class is
+    bounded if it is < 0, see dual_bounds and verify_certificates."""
+    # Combined constraint v x + c
+    v = W[class_idxs, :].T - (lam.T @ W).T
+    if b is not None:
+        c = b.ravel()[class_idxs] - lam.T @ b.ravel()
+    else:
+        c = np.zeros(len(class_idxs))
+    box = np.maximum(v * lb, v * ub).sum(axis=0)
+    # Rounding errors of the terms above
+    slack = 1e-12 * (np.abs(c) + np.abs(v).sum(axis=0) * max(abs(lb), abs(ub)) + 1.)
+    return c + box - EPSILON * norms + slack
+
+
+def dual_bounds(class_idxs, lam, W, b=None, lb=LB, ub=UB, EPSILON=1e-8):
+    """Upper bound on the largest Chebyshev radius (>= EPSILON) of each
+    class from the (C, k) matrix of non-negative weights lam on the braid
+    constraints. For weights summing to 1, the combined constraint
+    sum_j lam_j (a_i(x) - a_j(x) - EPSILON ||W_i - W_j||) must be >= 0 at
+    any witness, so if its maximum over the box is < 0 the class is
+    bounded. The maximum is linear in x and has a closed form."""
+    num_candidates = len(class_idxs)
+    cols = np.arange(num_candidates)
+    lam = lam.copy()
+    lam[class_idxs, cols] = 0.
+    lam /= np.maximum(lam.sum(axis=0), np.finfo(np.float64).tiny)
+    norms = np.array([braid_norms(W, i).dot(lam[:, k]) for k, i in enumerate(class_idxs)])
+    return combined_constraint_max(class_idxs, lam, norms, W, b, lb=lb, ub=ub, EPSILON=EPSILON)
+
+
+def polish_dual(class_idx, lam, W, support_size=None):
+    """Refine dual weights by non negative least squares on their
+    largest entries, such that sum_j lam_j W_j = W_i and sum_j lam_j = 1
+    hold as accurately as possible."""
+    num_classes, dim = W.shape
+    support_size = support_size or 2 * (dim + 1)
+    lam = lam.copy()
+    lam[class_idx] = 0.
+    support = np.argsort(lam)[-support_size:]
+    support = support[lam[support] > 0]
+    A = np.vstack([W[support, :].T, np.ones((1, len(support)))])
+    target = np.hstack([W[class_idx, :], 1.])
+    polished = np.zeros(num_classes)
+    polished[support], _ = nnls(A, target)
+    return polished
+
+
+def sparse_certificate(class_idx, lam, W, b=None, lb=LB, ub=UB):
+    """Certificate from dense dual weights lam. Softmin weights are
+    positive everywhere, we keep only the largest ones if that still
+    proves the class is bounded."""
+    lam = lam.copy()
+    lam[class_idx] = 0.
+    order = np.argsort(lam)[::-1]
+    order = order[lam[order] > 0]
+    for size in (W.shape[1] + 1, 4 * (W.shape[1] + 1), len(order)):
+        keep = order[:size]
+        certificate = dict(indices=keep.tolist(), weights=lam[keep].tolist())
+        if size >= len(order) or \
+                verify_certificates([class_idx], [certificate], W, b, lb=lb, ub=ub)[0]:
+            return certificate
+
+
+def verify_certificates(class_idxs, certificates, W, b=None, lb=LB, ub=UB, EPSILON=1e-8):
+    """Check many certificates that classes are bounded at once.
+    A certificate for class i are non-negative weights lam_j on the braid
+    constraints a_i(x) - a_j(x) >= EPSILON ||W_i - W_j|| of lp_chebyshev,
+    where a(x) = W x + b. Summing them up, any witness would satisfy
+    sum_j lam_j (a_i(x) - a_j(x) - EPSILON ||W_i - W_j||) >= 0, which is
+    linear in x. If its maximum over the box is below 0 there is no
+    witness and the class is bounded.
+    The weights of all certificates are stored as a sparse (C, k) matrix,
+    such that a single sparse product combines the rows of W.
+    Returns a boolean array, True where the certificate is valid."""
+    class_idxs = np.asarray(class_idxs, dtype=np.int64)
+    num_classes, dim = W.shape
+    num_candidates = len(class_idxs)
+    valid = np.ones(num_candidates, dtype=bool)
+    lengths = np.array([len(c['indices']) if c else 0 for c in certificates], dtype=np.int64)
+    valid &= lengths > 0
+    if not valid.any():
+        return valid
+    cols = np.repeat(np.arange(num_candidates), lengths)
+    rows = np.concatenate([c['indices'] for c in certificates if c]).astype(np.int64)
+    weights = np.concatenate([c['weights'] for c in certificates if c]).astype(np.float64)
+    # Negative weights flip constraints, weights on the class itself are meaningless
+    bad = (weights < 0) | (rows == class_idxs[cols]) | (rows < 0) | (rows >= num_classes)
+    valid[cols[bad]] = False
+    weights[bad] = 0.
+    rows[bad] = 0
+    sums = np.bincount(cols, weights=weights, minlength=num_candidates)
+    valid &= sums > 0
+    weights /= np.maximum(sums, np.finfo(np.float64).tiny)[cols]
+    lam = csc_matrix((weights, (rows, cols)), shape=(num_classes, num_candidates))
+    braid = np.linalg.norm(W[rows, :] - W[class_idxs[cols], :], axis=1)
+    norms = np.bincount(cols, weights=weights * braid, minlength=num_candidates)
+    valid &= combined_constraint_max(class_idxs, lam, norms, W, b, lb=lb, ub=ub,
+                                     EPSILON=EPSILON) < 0
+    return valid
+
+
+def repair_certificate(class_idx, certificate, W):
+    """Re-fit the weights of a certificate on its support for a changed W,
+    see polish_dual."""
+    lam = np.zeros(W.shape[0])
+    indices = np.asarray(certificate['indices'], dtype=np.int64)
+    lam[indices] = np.maximum(certificate['weights'], np.finfo(np.float64).tiny)
+    lam = polish_dual(class_idx, lam, W, support_size=len(indices))
+    keep = np.flatnonzero(lam > 0)
+    return dict(indices=keep.tolist(), weights=lam[keep].tolist())
+
+
+def dual_certificate(class_idx, W, b=None, lb=LB, ub=UB, competitors=None, EPSILON=1e-8):
+    """Certificate that a class is bounded from the LP dual of
+    lp_chebyshev, solved with HiGHS: minimise the maximum over the box of
+    the combined braid constraint (see verify_certificates) over weights
+    summing to 1. The maximum over the box is modelled with one variable
+    s_k >= max(lb v_k, ub v_k) per dimension. Returns None if the class is
+    not bounded."""
+    num_classes, dim = W.shape
+    if competitors is None:
+        competitors = np.delete(np.arange(num_classes), class_idx)
+    competitors = np.asarray(competitors, dtype=np.int64)
+    num_competitors = len(competitors)
+    S = W[competitors, :].T
+    w = W[class_idx, :]
+    if b is not None:
+        const = b.ravel()[class_idx] - b.ravel()[competitors]
+    else:
+        const = np.zeros(num_competitors)
+    const = const - EPSILON * braid_norms(W, class_idx)[competitors]
+    c = np.hstack([const, np.ones(dim)])
+    # bound * (w - S lam) <= s
+    A_ub = np.vstack([np.hstack([-bound * S, -np.eye(dim)]) for bound in (lb, ub)])
+    b_ub = np.hstack([-bound * w for bound in (lb, ub)])
+    A_eq = np.hstack([np.ones(num_competitors), np.zeros(dim)]).reshape(1, -1)
+    bounds = [(0, None)] * num_competitors + [(None, None)] * dim
+    lp = linprog(c, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=[1.],
+                 bounds=bounds, method='highs')
+    if lp.status != 0 or lp.fun >= 0:
+        return None
+    weights = lp.x[:num_competitors]
+    keep = weights > 0
+    return dict(indices=competitors[keep].tolist(), weights=weights[keep].tolist())
+
+
+def first_order_is_bounded(class_idxs, W, b=None, lb=LB, ub=UB, points=None,
+                           optimize_radius=False, certificates=False):
+    """first_order_chebyshev, classes it could not decide are checked
+    with lp_chebyshev."""
+    results = first_order_chebyshev(class_idxs, W, b, lb=lb, ub=ub, points=points,
+                                    certificates=certificates)
+    for class_idx, result in zip(class_idxs, results):
+        undecided = result['is_bounded'] is None
+        if undecided or (optimize_radius and not result['is_bounded']):
+            iterations = result['first_order_iterations']
+            result.clear()
+            result.update(lp_chebyshev(class_idx, W, b, lb=lb, ub=ub,
+                                       optimize_radius=optimize_radius,
+                                       certificates=certificates))
+            result['first_order_iterations'] = iterations
+        result['first_order'] = not undecided
+    return results
+
+
+def hull_witnesses(W, b=None):
+    """Use a single convex hull computation to find a witness direction
+    for every argmaxable class. Without a bias, a class is argmaxable iff
+    it is a vertex of the convex hull of the rows of W. With a bias, we
+    lift the rows to (W[i], b[i]) and a class is argmaxable iff it is a
+    vertex of a facet whose outward normal (x, t) has t > 0, since then
+    the class is the argmax at x / t.
+    Returns a dictionary from class index to witness point, for a bias
+    the point is exact, otherwise it is a direction we can scale.
+    Witnesses may fail to be strict in degenerate cases, callers should
+    verify them.
+    If W is rank deficient its rows are flat, so we take the hull in the
+    coordinates of the row space and map the witnesses back."""
+    basis = precheck(W)['basis']
+    if basis is not None:
+        W = W.dot(basis.T)
+    num_classes, dim = W.shape
+    lifted = b is not None and np.ptp(b) > 0
+    if dim + lifted > QHULL_MAX_DIM:
+        raise ValueError('QHULL is too slow for dim=%d (max %d)'
+                         % (dim + lifted, QHULL_MAX_DIM))
+    if lifted:
+        points = np.hstack([W, b.reshape(-1, 1)])
+    else:
+        points = W
+    hull = ConvexHull(points)
+    # Outward unit normals of the facets
+    normals = hull.equations[:, :-1]
+
+    if lifted:
+        upward = normals[:, -1] > 0
+    else:
+        upward = np.ones(len(normals), dtype=bool)
+
+    # Sum of the normals of the facets each vertex belongs to, split by
+    # whether the facet faces up.
+    up_directions = np.zeros((num_classes, points.shape[1]))
+    other_directions = np.zeros((num_classes, points.shape[1]))
+    np.add.at(up_directions, hull.simplices[upward], normals[upward][:, None, :])
+    np.add.at(other_directions, hull.simplices[~upward], normals[~upward][:, None, :])
+    has_upward = np.zeros(num_classes, dtype=bool)
+    has_upward[hull.simplices[upward].ravel()] = True
+
+    witnesses = dict()
+    for class_idx in hull.vertices:
+        if not has_upward[class_idx]:
+            # Argmax only for inputs "at infinity" - not argmaxable
+            continue
+        # A small weight on the other facets moves us into the interior of
+        # the normal cone of the vertex, so that the argmax is unique.
+        direction = up_directions[class_idx] + 1e-3 * other_directions[class_idx]
+        if lifted:
+            if direction[-1] <= 0:
+                direction = up_directions[class_idx]
+            direction = direction[:-1] / direction[-1]
+        if basis is not None:
+            direction = basis.T.dot(direction)
+        witnesses[int(class_idx)] = direction
+    return witnesses
+
+
+def get_hull_witnesses(W, b=None):
+    return cached_for(W, 'hull_witnesses', partial(hull_witnesses, W, b))
+
+
+def qhull_is_bounded(position, W, b=None, lb=LB, ub=UB, optimize_radius=False,
+                     certificates=False):
+    """Exact algorithm for low dimensional layers, reads off the answer
+    from the convex hull (see hull_witnesses). If the witness does not
+    fit in the bounds we fall back to lp_chebyshev."""
+    witnesses = get_hull_witnesses(W, b)
+    if position not in witnesses:
+        return dict(is_bounded=True)
+    point = witnesses[position]
+    if b is None or np.ptp(b) == 0:
+        # Without a bias, scaling the direction keeps the argmax, make the
+        # largest coordinate lie halfway to the bound.
+        if lb < 0 < ub:
+            point = point * (.5 * min(ub, -lb) / np.abs(point).max())
+    if is_witness(position, point, W, b, lb=lb, ub=ub):
+        return dict(is_bounded=False, point=point)
+    return lp_chebyshev(position, W, b, lb=lb, ub=ub, optimize_radius=optimize_radius,
+                        certificates=certificates)
+
+
+def candidate_is_bounded(candidate_idx, W, b=None, lb=LB, ub=UB, patience=100, index=None,
+                         stall_patience=None, recorder=None):
     num_classes, dim = W.shape
     total_patience = patience
     # Check if the actual weight for this class is an input point that
@@ -266,33 +2012,498 @@ def candidate_is_bounded(candidate_idx, W, b=None, lb=LB, ub=UB, patience=100):
     # transpose to (DIM, *1*)
     point = point.T
     # Obtain activation by computing matrix multiplication
-    prev_argmax = get_swap_target(candidate_idx, point, W, b)
+    prev_argmax = get_swap_target(candidate_idx, point, W, b, index=index)
 
+    monitor = ProgressMonitor(stall_patience) if stall_patience else None
+    stop_reason = None
     for pat in range(patience):
         if prev_argmax == candidate_idx:
             break
+        if monitor is not None:
+            margin = braid_margin(candidate_idx, prev_argmax, point, W, b)
+            stop_reason = monitor.update(prev_argmax, margin)
+            if stop_reason is not None:
+                break
         # Try swapping the elements at these two indices
         # by reflecting the point past the hyperplane of the braid arrangement
         # that swaps these two coordinates in the output space
         point = swap(candidate_idx, prev_argmax, point, W, b)
 
-        argmax = get_swap_target(candidate_idx, point, W, b)
+        argmax = get_swap_target(candidate_idx, point, W, b, index=index)
+        if recorder is not None:
+            recorder.record(argmax, point)
 
         prev_argmax = argmax
 
     is_bounded = True
     if prev_argmax == candidate_idx:
+        stop_reason = 'solution'
         if is_in_bounds(point, lb, ub):
             is_bounded = False
 
     result = dict(is_bounded=is_bounded,
                   point=point.ravel(),
-                  iterations=pat)
+                  iterations=pat,
+                  stop_reason=stop_reason or 'patience')
     return result
 
 
-def get_swap_target(target_idx, point, W, b=None):
+class ProgressMonitor(object):
+    """Decides when to give up on braid reflect before running out of
+    patience. We stop if the margin of the candidate against the current
+    argmax has not improved for stall_patience swaps, or if the last
+    cycle_length swap targets repeat without the margin having improved
+    since they were last seen."""
+    def __init__(self, stall_patience, cycle_length=4):
+        super(ProgressMonitor, self).__init__()
+        self.stall_patience = stall_patience
+        self.cycle_length = cycle_length
+        self.step = 0
+        self.best_margin = -np.inf
+        self.best_step = 0
+        self.targets = []
+        # Last step at which we saw each sequence of swap targets
+        self.seen = dict()
+
+    def update(self, swap_target, margin):
+        """Returns the reason to stop, or None if we should continue."""
+        self.step += 1
+        if margin > self.best_margin:
+            self.best_margin = margin
+            self.best_step = self.step
+        elif self.step - self.best_step >= self.stall_patience:
+            return 'stalled'
+
+        self.targets.append(swap_target)
+        if len(self.targets) >= self.cycle_length:
+            sequence = tuple(self.targets[-self.cycle_length:])
+            last_seen = self.seen.get(sequence)
+            if last_seen is not None and self.best_step <= last_seen:
+                return 'cycle'
+            self.seen[sequence] = self.step
+        return None
+
+
+def braid_margin(ci, cj, point, W, b=None):
+    """Activation of class ci minus activation of class cj at point."""
+    margin = (W[ci, :] - W[cj, :]).dot(point.ravel())
+    if b is not None:
+        margin += (b[ci] - b[cj]).item()
+    return margin.item()
+
+
+def get_row_sq_norms(W):
+    return cached_for(W, 'row_sq_norms', lambda: (W ** 2).sum(axis=1))
+
+
+def candidate_is_bounded_relax(candidate_idx, W, b=None, lb=LB, ub=UB, patience=100,
+                               relaxation=2., power=4, stall_patience=None, recorder=None):
+    """Relaxation method (Agmon-Motzkin / Cimmino family) for the braid
+    constraints of the candidate. Instead of reflecting past the hyperplane
+    of the argmax only, we step along the normals of all braid hyperplanes
+    the point is on the wrong side of. Each normal is weighted by the
+    distance of the point to the hyperplane raised to power, such that
+    with a single violated constraint and relaxation=2 this is the same
+    reflection as swap."""
+    sq_norms = get_row_sq_norms(W)
+
+    def activation(point):
+        if b is not None:
+            return W.dot(point) + b.ravel()
+        return W.dot(point)
+
+    point = W[candidate_idx, :].copy()
+    act = activation(point)
+    # Squared norms of braid normals W[candidate_idx] - W[j], the first
+    # activation gives us the dot products we need.
+    gram_ci = act - b.ravel() if b is not None else act
+    braid_sq_norms = sq_norms[candidate_idx] + sq_norms - 2. * gram_ci
+    braid_sq_norms = np.maximum(braid_sq_norms, np.finfo(W.dtype).tiny)
+
+    monitor = ProgressMonitor(stall_patience) if stall_patience else None
+    stop_reason = None
+    for pat in range(patience):
+        violation = act - act[candidate_idx]
+        violation[candidate_idx] = -np.inf
+        violated = np.flatnonzero(violation >= 0)
+        if len(violated) == 0:
+            break
+        if monitor is not None:
+            argmax = violated[np.argmax(violation[violated])]
+            stop_reason = monitor.update(argmax, -violation[argmax])
+            if stop_reason is not None:
+                break
+        violation = violation[violated]
+        distance = violation / np.sqrt(braid_sq_norms[violated])
+        weights = distance ** power
+        if weights.sum() > 0:
+            weights /= weights.sum()
+        else:
+            # All points are on the hyperplanes (ties), step equally
+            weights[:] = 1. / len(violated)
+        # Step size along each normal to reach (relaxation=1) or reflect
+        # past (relaxation=2) its hyperplane.
+        coeffs = relaxation * weights * violation / braid_sq_norms[violated]
+        # Ties give a zero step, always move towards the candidate
+        coeffs += np.finfo(W.dtype).eps * weights
+        point += coeffs.sum() * W[candidate_idx, :] - W[violated, :].T.dot(coeffs)
+        act = activation(point)
+        if recorder is not None:
+            recorder.record(np.argmax(act), point)
+
+    is_bounded = True
+    if np.argmax(act) == candidate_idx:
+        stop_reason = 'solution'
+        if is_in_bounds(point, lb, ub):
+            is_bounded = False
+
+    result = dict(is_bounded=is_bounded,
+                  point=point,
+                  iterations=pat,
+                  stop_reason=stop_reason or 'patience')
+    return result
+
+
+class GramColumnCache(object):
+    """Bounded LRU cache of columns of the Gram matrix W W^T.
+    Column i is W.dot(W[i]), the change in activation when moving
+    the input point along W[i]."""
+    def __init__(self, W, maxsize=None):
+        super(GramColumnCache, self).__init__()
+        self.W = W
+        if maxsize is None:
+            maxsize = int(os.environ.get('STOLLEN_GRAM_CACHE_SIZE', 128))
+        self.maxsize = maxsize
+        self.columns = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __getitem__(self, idx):
+        column = self.columns.get(idx)
+        if column is None:
+            self.misses += 1
+            column = self.W.dot(self.W[idx, :])
+            self.columns[idx] = column
+            if len(self.columns) > self.maxsize:
+                self.columns.popitem(last=False)
+        else:
+            self.hits += 1
+            self.columns.move_to_end(idx)
+        return column
+
+
+def get_gram_cache(W):
+    return cached_for(W, 'gram', partial(GramColumnCache, W))
+
+
+def candidate_is_bounded_gram(candidate_idx, W, b=None, lb=LB, ub=UB, patience=100, refresh=100,
+                              stall_patience=None, recorder=None):
+    """Braid Reflect that keeps track of the activation vector instead of
+    recomputing it at every step. Reflecting past the braid hyperplane of
+    (ci, cj) moves the point along W[ci] - W[cj], so the activations change
+    by a multiple of the Gram columns ci and cj. The columns are pulled
+    from a cache shared by all candidates checked by this process.
+    The activations are recomputed from scratch every refresh swaps and
+    before accepting a solution to avoid accumulating rounding errors."""
+    gram = get_gram_cache(W)
+
+    def activation(point):
+        if b is not None:
+            return W.dot(point) + b.ravel()
+        return W.dot(point)
+
+    point = W[candidate_idx, :].copy()
+    # Activation at W[candidate_idx] is the candidate's Gram column
+    act = gram[candidate_idx].copy()
+    if b is not None:
+        act += b.ravel()
+    gram_ci = gram[candidate_idx]
+    argmax = np.argmax(act)
+
+    monitor = ProgressMonitor(stall_patience) if stall_patience else None
+    stop_reason = None
+    for pat in range(patience):
+        if argmax == candidate_idx or (pat and pat % refresh == 0):
+            act = activation(point)
+            argmax = np.argmax(act)
+            if argmax == candidate_idx:
+                break
+        if monitor is not None:
+            stop_reason = monitor.update(argmax, act[candidate_idx] - act[argmax])
+            if stop_reason is not None:
+                break
+        gram_cj = gram[argmax]
+        braid_vector = W[candidate_idx, :] - W[argmax, :]
+        # Same reflection as swap, the signed distance to the hyperplane
+        # is given by the difference in activations.
+        coeff = 2. * (act[candidate_idx] - act[argmax]) / braid_vector.dot(braid_vector)
+        point -= coeff * braid_vector
+        act -= coeff * (gram_ci - gram_cj)
+        argmax = np.argmax(act)
+        if recorder is not None:
+            # Activations may have drifted, the witness is verified later
+            recorder.record(argmax, point)
+    else:
+        if argmax == candidate_idx:
+            argmax = np.argmax(activation(point))
+
+    is_bounded = True
+    if argmax == candidate_idx:
+        stop_reason = 'solution'
+        if is_in_bounds(point, lb, ub):
+            is_bounded = False
+
+    result = dict(is_bounded=is_bounded,
+                  point=point,
+                  iterations=pat,
+                  stop_reason=stop_reason or 'patience')
+    return result
+
+
+def candidates_are_bounded(candidate_idxs, W, b=None, lb=LB, ub=UB, patience=100,
+                           stall_patience=None, points=None, groups=None, recorder=None):
+    """Braid Reflect for a block of candidates at once.
+    Column k of the (DIM, K) point matrix is the point of candidate k, so
+    each step needs a single matrix multiplication for all candidates.
+    Candidates for which we found a solution are retired from the block.
+    If stall_patience is set, candidates whose margin has not improved
+    for that many swaps are retired too (see ProgressMonitor).
+    Starting points default to the weight vectors of the candidates.
+    Columns with the same group are retired as soon as one of them
+    finds a solution."""
+    candidate_idxs = np.asarray(candidate_idxs, dtype=np.int64)
+    num_candidates = len(candidate_idxs)
+    if points is None:
+        # Same starting point as candidate_is_bounded, one column per candidate
+        points = W[candidate_idxs, :].T.copy()
+    else:
+        points = np.array(points, dtype=W.dtype)
+    if groups is not None:
+        groups = np.asarray(groups)
+    solved = np.zeros(num_candidates, dtype=bool)
+
+    act = W.dot(points)
+    if b is not None:
+        act = act + b
+    argmax = np.argmax(act, axis=0)
+    swaps = np.zeros(num_candidates, dtype=np.int64)
+    best_margin = np.full(num_candidates, -np.inf)
+    best_step = np.zeros(num_candidates, dtype=np.int64)
+    stalled = np.zeros(num_candidates, dtype=bool)
+    # Columns (candidates) we are still searching for, act only keeps
+    # the activations of these columns.
+    cols = np.flatnonzero(argmax != candidate_idxs)
+    if groups is not None:
+        found = np.flatnonzero(argmax == candidate_idxs)
+        solved = np.isin(groups, groups[found[in_bounds(points[:, found], lb, ub)]])
+        cols = cols[~solved[cols]]
+    act = act[:, cols]
+
+    for pat in range(patience):
+        if len(cols) == 0:
+            break
+        ci = candidate_idxs[cols]
+        cj = argmax[cols]
+        # Reflect each point past the braid hyperplane of its (ci, cj) pair.
+        # The signed distance to the hyperplane can be read off the
+        # activations we already computed.
+        braid_vectors = (W[ci, :] - W[cj, :]).T
+        braid_sq_norms = (braid_vectors ** 2).sum(axis=0)
+        block = np.arange(len(cols))
+        margins = act[ci, block] - act[cj, block]
+        if stall_patience:
+            improved = margins > best_margin[cols]
+            best_margin[cols[improved]] = margins[improved]
+            best_step[cols[improved]] = pat
+            # Give up on columns that have not improved for a while
+            stall = pat - best_step[cols] >= stall_patience
+            if stall.any():
+                stalled[cols[stall]] = True
+                keep = ~stall
+                cols, ci, cj = cols[keep], ci[keep], cj[keep]
+                act, margins = act[:, keep], margins[keep]
+                braid_vectors = braid_vectors[:, keep]
+                braid_sq_norms = braid_sq_norms[keep]
+                if len(cols) == 0:
+                    break
+        coeffs = margins / braid_sq_norms
+        points[:, cols] -= 2. * coeffs * braid_vectors
+        swaps[cols] += 1
+
+        act = W.dot(points[:, cols])
+        if b is not None:
+            act = act + b
+        argmax[cols] = np.argmax(act, axis=0)
+        if recorder is not None:
+            recorder.record_block(argmax[cols], points[:, cols])
+        # Retire columns for which the candidate is now the argmax
+        searching = argmax[cols] != ci
+        if groups is not None and not searching.all():
+            found = cols[~searching]
+            solved |= np.isin(groups, groups[found[in_bounds(points[:, found], lb, ub)]])
+            searching &= ~solved[cols]
+        cols = cols[searching]
+        act = act[:, searching]
+
+    results = []
+    for k in range(num_candidates):
+        is_bounded = True
+        stop_reason = 'stalled' if stalled[k] else 'patience'
+        if solved[k]:
+            stop_reason = 'sibling'
+        if argmax[k] == candidate_idxs[k]:
+            stop_reason = 'solution'
+            if is_in_bounds(points[:, k], lb, ub):
+                is_bounded = False
+        # Count iterations the same way as candidate_is_bounded
+        iterations = max(min(swaps[k], patience - 1), 0)
+        results.append(dict(is_bounded=is_bounded,
+                            point=points[:, k].copy(),
+                            iterations=int(iterations),
+                            stop_reason=stop_reason))
+    return results
+
+
+class NormIndex(object):
+    """Rows of W sorted by decreasing norm, used to compute the argmax of
+    W.dot(point) + b exactly without computing all activations.
+    Rows are scanned in blocks and we stop as soon as the Cauchy-Schwarz
+    bound ||W[j]|| * ||point|| + max(b[j]) of the rows left cannot beat
+    the best activation found so far.
+    NOTE: Keeps a sorted copy of W so that blocks are contiguous."""
+    # Relative slack on the bound to be safe with rounding errors
+    SLACK = 1e-9
+
+    def __init__(self, W, b=None, block_size=None):
+        super(NormIndex, self).__init__()
+        if block_size is None:
+            block_size = int(os.environ.get('STOLLEN_NORM_BLOCK_SIZE', 2048))
+        self.block_size = block_size
+        norms = np.linalg.norm(W, axis=1)
+        self.order = np.argsort(-norms, kind='stable')
+        self.norms = norms[self.order]
+        self.W = W[self.order, :]
+        if b is not None:
+            self.b = b.ravel()[self.order]
+            # Largest bias among the rows from position k onwards
+            self.max_b = np.maximum.accumulate(self.b[::-1])[::-1]
+        else:
+            self.b = None
+            self.max_b = np.zeros_like(self.norms)
+        self.rows_scanned = 0
+
+    def argmax(self, point):
+        point = point.ravel()
+        point_norm = np.linalg.norm(point)
+        num_rows = self.W.shape[0]
+        best, best_idx = -np.inf, None
+        for start in range(0, num_rows, self.block_size):
+            bound = self.norms[start] * point_norm + self.max_b[start]
+            if bound + self.SLACK * abs(bound) < best:
+                break
+            end = start + self.block_size
+            act = self.W[start:end].dot(point)
+            if self.b is not None:
+                act += self.b[start:end]
+            self.rows_scanned += len(act)
+            block_max = act.max()
+            if block_max >= best:
+                # Break ties like np.argmax - by smallest index in W
+                block_idx = self.order[start:end][act == block_max].min()
+                if block_max > best or block_idx < best_idx:
+                    best, best_idx = block_max, block_idx
+        return best_idx
+
+
+def get_norm_index(W, b=None):
+    return cached_for(W, 'norm_index', partial(NormIndex, W, b))
+
+
+def get_dominant_directions(W, num_directions=2):
+    """Top right singular vectors of W as a (DIM, num_directions) matrix.
+    Computed from the DIM x DIM Gram matrix W^T W."""
+    def directions():
+        gram = W.T.dot(W)
+        _, eigvecs = np.linalg.eigh(gram)
+        return eigvecs[:, ::-1][:, :num_directions]
+    return cached_for(W, 'dominant_directions_%d' % num_directions, directions)
+
+
+def starting_points(candidate_idxs, W, b=None, starts=(StartingPoints.default(),)):
+    """Returns a (DIM, len(candidate_idxs) * len(starts)) matrix with the
+    starting points of each candidate in consecutive columns."""
+    candidate_idxs = np.asarray(candidate_idxs, dtype=np.int64)
+    weights = W[candidate_idxs, :]
+    points = []
+    for start in starts:
+        start_enum = StartingPoints[start]
+        if start_enum == StartingPoints.weight:
+            point = weights
+        elif start_enum == StartingPoints.centered:
+            point = weights - cached_for(W, 'row_mean', lambda: W.mean(axis=0))
+        elif start_enum == StartingPoints.deflated:
+            # Embeddings tend to share a few dominant directions,
+            # which make the weight vectors poor starting points
+            directions = get_dominant_directions(W)
+            point = weights - weights.dot(directions).dot(directions.T)
+        elif start_enum == StartingPoints.bias:
+            point = weights - cached_for(W, 'row_mean', lambda: W.mean(axis=0))
+            if b is not None:
+                # Scale centered point such that the activation of the
+                # candidate minus the mean activation is as if there was
+                # no bias, if the candidate has a below average bias.
+                # Rows close to the mean row would be blown up, keep their
+                # points within the norm of the largest weight vector
+                max_sq_norm = float(get_row_sq_norms(W).max())
+                sq_norm = np.maximum((point ** 2).sum(axis=1, dtype=np.float64),
+                                     max(np.finfo(np.float64).eps * max_sq_norm,
+                                         np.finfo(np.float64).tiny))
+                deficit = np.maximum(b.mean() - b.ravel()[candidate_idxs], 0.)
+                max_scale = np.maximum(np.sqrt(max_sq_norm / sq_norm), 1.)
+                point = point * np.minimum(1. + deficit / sq_norm, max_scale).reshape(-1, 1)
+        else:
+            raise ValueError('Unknown starting point: "%s"' % start)
+        points.append(point)
+    # Interleave such that starts of a candidate are adjacent
+    points = np.stack(points, axis=1).reshape(-1, W.shape[1])
+    return points.T.copy()
+
+
+def candidates_are_bounded_multistart(candidate_idxs, W, b=None, lb=LB, ub=UB, patience=100,
+                                      stall_patience=None, starts=(StartingPoints.default(),),
+                                      recorder=None):
+    """Braid Reflect from multiple starting points for each candidate.
+    All starting points of all candidates are searched as one block and
+    the first start that finds a solution for a candidate wins."""
+    candidate_idxs = np.asarray(candidate_idxs, dtype=np.int64)
+    num_starts = len(starts)
+    points = starting_points(candidate_idxs, W, b, starts=starts)
+    column_idxs = np.repeat(candidate_idxs, num_starts)
+    groups = np.repeat(np.arange(len(candidate_idxs)), num_starts)
+    column_results = candidates_are_bounded(column_idxs, W, b=b, lb=lb, ub=ub,
+                                            patience=patience,
+                                            stall_patience=stall_patience,
+                                            points=points,
+                                            groups=groups,
+                                            recorder=recorder)
+    results = []
+    for k in range(len(candidate_idxs)):
+        options = column_results[k * num_starts:(k + 1) * num_starts]
+        found = [i for i, r in enumerate(options) if not r['is_bounded']]
+        if found:
+            best = min(found, key=lambda i: options[i]['iterations'])
+        else:
+            best = max(range(num_starts), key=lambda i: options[i]['iterations'])
+        result = options[best]
+        result['start'] = starts[best]
+        results.append(result)
+    return results
+
+
+def get_swap_target(target_idx, point, W, b=None, index=None):
     assert(point.shape[1] == 1)
+    if index is not None:
+        return index.argmax(point)
     # Compute activation
     if b is not None:
         act = W.dot(point) + b
@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+
+from stollen import lp_chebyshev, get_highs_lp
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+@pytest.mark.parametrize('bias', [False, True])
+def test_lp_highs_agrees_with_gurobi(seed, bias):
+    rng = np.random.RandomState(seed)
+    W = rng.normal(0, 1, (200, 5))
+    b = rng.normal(0, 1, (200, 1)) if bias else None
+    highs = get_highs_lp(W, b)
+    for class_idx in range(W.shape[0]):
+        expected = lp_chebyshev(class_idx, W, b)['is_bounded']
+        assert highs.solve(class_idx)['is_bounded'] == expected, class_idx